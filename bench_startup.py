@@ -0,0 +1,146 @@
+"""Startup benchmark: time-to-first-response of a freshly spawned process.
+
+Каждый прогон — отдельный интерпретатор (как пробуждение на free plan):
+импорт main, сборка приложения, initialize/start, обработка /start от
+зарегистрированного пользователя. Сеть Telegram подменена заглушкой,
+каждый вызов API ждёт --rtt мс, измеряется момент отправки первого sendMessage.
+
+    python bench_startup.py --runs 5 --users 2000 --rtt 150
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_UID = 424242
+
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": BENCH_UID, "type": "private"},
+        "from": {"id": BENCH_UID, "is_bot": False, "first_name": "bench"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+def child():
+    t0 = float(os.environ["BENCH_T0"])
+    rtt = float(os.environ.get("BENCH_RTT_MS", "0")) / 1000.0
+
+    import asyncio
+    import main
+    from telegram import Update
+    from telegram.request import BaseRequest
+
+    t_import = time.time()
+    first_reply = []
+
+    message = {
+        "message_id": 2,
+        "date": 0,
+        "chat": {"id": BENCH_UID, "type": "private"},
+        "text": "ok",
+    }
+    results = {
+        "getMe": {"id": 1, "is_bot": True, "first_name": "nez", "username": "nez_bot"},
+        "getWebhookInfo": {"url": "", "has_custom_certificate": False, "pending_update_count": 0},
+        "setWebhook": True,
+    }
+
+    class FakeRequest(BaseRequest):
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            name = url.rsplit("/", 1)[-1]
+            await asyncio.sleep(rtt)
+            if name == "sendMessage" and not first_reply:
+                first_reply.append(time.time())
+            return 200, json.dumps({"ok": True, "result": results.get(name, message)}).encode()
+
+    async def run():
+        app = main.build_app(request=FakeRequest())
+        await app.initialize()
+        await app.start()
+        if main.BASE_URL:
+            await main.sync_webhook(app)
+        await main.post_init(app)
+        t_ready = time.time()
+
+        await app.process_update(Update.de_json(START_UPDATE, app.bot))
+
+        await app.stop()
+        await app.shutdown()
+        return t_ready
+
+    t_ready = asyncio.run(run())
+    print(json.dumps({
+        "import": t_import - t0,
+        "ready": t_ready - t0,
+        "first_response": (first_reply[0] if first_reply else time.time()) - t0,
+    }))
+
+def spawn(env) -> dict:
+    env = dict(env, BENCH_T0=repr(time.time()))
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def seed(db_path: str, users: int):
+    conn = sqlite3.connect(db_path)
+    now = int(time.time())
+    conn.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", (BENCH_UID, "bench", 10, now))
+    conn.executemany(
+        "INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)",
+        [(i, f"u{i}", i % 300, now) for i in range(1, users + 1)]
+    )
+    conn.commit()
+    conn.close()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--child", action="store_true")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--rtt", type=float, default=150.0)
+    args = ap.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_env = dict(
+            os.environ,
+            BOT_TOKEN="1:bench",
+            DB_PATH=os.path.join(tmp, "nez.db"),
+            BASE_URL="https://bench.invalid",
+            BENCH_RTT_MS=str(args.rtt),
+        )
+        spawn(base_env)  # схема
+        seed(base_env["DB_PATH"], args.users)
+
+        for mode in ("0", "1"):
+            env = dict(base_env, COLD_START=mode)
+            samples = [spawn(env) for _ in range(args.runs)]
+            print(f"COLD_START={mode} ({args.runs} runs, {args.users} users, rtt {args.rtt:.0f} ms)")
+            for key in ("import", "ready", "first_response"):
+                vals = [s[key] * 1000 for s in samples]
+                print(f"  {key:<15} median {statistics.median(vals):8.1f} ms   min {min(vals):8.1f} ms")
+
+if __name__ == "__main__":
+    main()
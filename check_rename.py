@@ -0,0 +1,97 @@
+"""Rename batch check: apply_rename_decisions в одной пачке.
+
+Каждый прогон — отдельный интерпретатор (DB_PATH/DB_SHARDS читаются при импорте main):
+  1. имя переходит от одного пользователя к другому в той же пачке
+     (U2 n2→q, U1 n1→y, U2 →n1) — применяется без конфликта UNIQUE;
+  2. сбой посреди пачки откатывает её целиком: имена и статусы заявок не меняются.
+
+    python check_rename.py
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def request(conn, uid: int, old: str, new: str) -> int:
+    cur = conn.execute(
+        "INSERT INTO username_changes (user_id, old_username, new_username, status, created_at) "
+        "VALUES (?, ?, ?, 'PENDING', ?)",
+        (uid, old, new, int(time.time()))
+    )
+    conn.commit()
+    return cur.lastrowid
+
+def names(conn, uids) -> list:
+    import main
+    return [conn.execute(main.shard_sql(u, "SELECT username FROM {users} WHERE user_id=?"), (u,)).fetchone()[0]
+            for u in uids]
+
+def statuses(conn, rids) -> list:
+    return [conn.execute("SELECT status FROM username_changes WHERE id=?", (r,)).fetchone()[0] for r in rids]
+
+def child():
+    import main
+    conn = main.db()
+    # пары в одном шарде: UNIQUE(username) действует внутри файла шарда
+    u1 = 1
+    u2, u3 = [u for u in range(2, 1000) if main.shard_of(u) == main.shard_of(u1)][:2]
+    for uid, name in ((u1, "n1"), (u2, "n2"), (u3, "n3")):
+        main.create_user(conn, uid, name)
+    main.refresh_rank(conn)
+
+    rids = [request(conn, u2, "n2", "q"), request(conn, u1, "n1", "y"), request(conn, u2, "q", "n1")]
+    handed = main.apply_rename_decisions(conn, [(r, True) for r in rids])[:2]
+    result = {
+        "handed": handed,
+        "handed_names": names(conn, (u1, u2)),
+        "handed_statuses": statuses(conn, rids),
+        "handed_cache": [main._user_rows[u][1] for u in (u1, u2)],
+    }
+
+    # имя занято в базе, но кэш об этом не знает — UPDATE падает на второй заявке пачки
+    conn.execute(main.shard_sql(u3, "UPDATE {users} SET username='z' WHERE user_id=?"), (u3,))
+    conn.commit()
+    rids = [request(conn, u1, "y", "w"), request(conn, u2, "n1", "z")]
+    try:
+        main.apply_rename_decisions(conn, [(r, True) for r in rids])
+        result["failed"] = False
+    except main.sqlite3.Error:
+        result["failed"] = True
+    result["rolled_back_names"] = names(conn, (u1, u2))
+    result["rolled_back_statuses"] = statuses(conn, rids)
+    print(json.dumps(result, ensure_ascii=False))
+
+def check(cond: bool, what: str):
+    if not cond:
+        sys.exit("FAIL: " + what)
+    print("ok  " + what)
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        child()
+        return
+
+    for shards in ("1", "3"):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, BOT_TOKEN="1:check", COLD_START="0",
+                       DB_PATH=os.path.join(tmp, "nez.db"), DB_SHARDS=shards)
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"],
+                                 env=env, capture_output=True, text=True, cwd=HERE)
+            if out.returncode != 0:
+                sys.exit(f"DB_SHARDS={shards}: child failed:\n{out.stderr}")
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            tag = f"[{shards} shard(s)] "
+            check(r["handed"] == [3, 0] and r["handed_statuses"] == ["APPROVED"] * 3,
+                  tag + "name handed over within one batch: all approved")
+            check(r["handed_names"] == ["y", "n1"] and r["handed_cache"] == ["y", "n1"],
+                  tag + "database and cache hold the final names")
+            check(r["failed"] and r["rolled_back_names"] == ["y", "n1"]
+                  and r["rolled_back_statuses"] == ["PENDING"] * 2,
+                  tag + "failed batch rolled back as a whole")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Storage check: migrations from the baseline schema and reshard round-trip.
+
+Каждый шаг — отдельный интерпретатор (DB_PATH/DB_SHARDS читаются при импорте main):
+  1. база в исходной схеме (user_version 0) с историей пакетов -> main.db() мигрирует;
+     проверяются тексты пакетов, счётчики статистики, прогресс, порядок очереди;
+  2. старт с другим DB_SHARDS должен упасть, не создав файлов шардов;
+  3. reshard 1 -> 3 -> 1: содержимое совпадает со снимком после миграции,
+     волна пакетов в шардах пишет счётчики вместе с anomalies;
+  4. после записи в шарды (id anomalies в шардах пересекаются) reshard 3 -> 1
+     сливает их без потерь, выгрузка истории различает строки разных шардов.
+
+    python check_storage.py
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+USERS = 120
+
+BASELINE_SCHEMA = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT UNIQUE, points INTEGER DEFAULT 0, created_at INTEGER);
+CREATE TABLE anomalies (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, kind TEXT, payload TEXT,
+                        status TEXT, created_at INTEGER, fixed_at INTEGER);
+CREATE TABLE s_audio (id INTEGER PRIMARY KEY AUTOINCREMENT, file_id TEXT UNIQUE);
+CREATE TABLE scheduler_meta (k TEXT PRIMARY KEY, v TEXT);
+CREATE TABLE username_changes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, old_username TEXT,
+                               new_username TEXT, status TEXT, created_at INTEGER);
+CREATE TABLE user_limits (user_id INTEGER PRIMARY KEY, username_change_used INTEGER DEFAULT 0);
+CREATE TABLE user_activity (user_id INTEGER PRIMARY KEY, score REAL DEFAULT 0, updated_at INTEGER);
+"""
+
+def seed_baseline(path: str) -> dict:
+    import main
+    rnd = random.Random(7)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO s_audio (file_id) VALUES (?)", [("audio-1",), ("audio-2",)])
+    texts = main.FRAGMENT_SNIPPETS + main.LORE_SNIPPETS + main.NOCLASS_TEXT
+    created = fixed = 0
+    for uid in range(1, USERS + 1):
+        conn.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (uid, f"u{uid}", rnd.randint(0, 300), now - 86400 * 9))
+        conn.execute("INSERT INTO user_limits VALUES (?, ?)", (uid, rnd.randint(0, 2)))
+        conn.execute("INSERT INTO user_activity VALUES (?, ?, ?)",
+                     (uid, rnd.choice([0.0, rnd.uniform(1, 80)]), now - rnd.randint(0, 86400 * 5)))
+        for _ in range(rnd.randint(0, 6)):
+            kind = rnd.choice("SN")
+            payload = rnd.choice(["audio-1", "audio-2"]) if kind == "S" else rnd.choice(texts)
+            status = rnd.choice(["NEW", "FIXED", "DONE", "EXPIRED"])
+            ts = now - rnd.randint(3600, 86400 * 8)
+            fx = ts + rnd.randint(1, 300) if status in ("FIXED", "DONE") else None
+            conn.execute(
+                "INSERT INTO anomalies (user_id, kind, payload, status, created_at, fixed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, kind, payload, status, ts, fx)
+            )
+            created += 1
+            fixed += fx is not None
+    conn.commit()
+    conn.close()
+    return {"created": created, "fixed": fixed}
+
+def snapshot() -> dict:
+    import main
+    now = int(os.environ["CHECK_NOW"])
+    main.ranking_now = lambda conn: now  # один и тот же момент во всех шагах
+    conn = main.db()
+    main.warm_user_cache(conn)
+    main.warm_progress_cache(conn)
+    history = list(main.iter_history_export(conn))
+    anomalies = sorted(
+        (uid, kind, main.payload_text(conn, pid), status, created_at, fixed_at)
+        for uid, kind, pid, status, created_at, fixed_at in main.scatter(
+            conn, "SELECT user_id, kind, payload_id, status, created_at, fixed_at FROM {anomalies}"
+        )
+    )
+    return {
+        "version": conn.execute("PRAGMA user_version").fetchone()[0],
+        "shards": main.get_meta(conn, main.SHARDS_META_KEY),
+        "users": sorted(main._user_rows.values()),
+        "limits": sorted(main._user_limits.items()),
+        "activity": sorted((u, None if k is None else round(k, 9)) for u, k in main._user_activity.items()),
+        "progress": sorted((u, str(bits)) for u, bits in main._user_seen.items() if bits),
+        "anomalies": anomalies,
+        "stats": main.stats_get(conn, "all"),
+        "export_keys_unique": len({(r["shard"], r["id"]) for r in history}) == len(history),
+        "queue": [uid for uid, _, _ in main.ordered_users(conn)],
+    }
+
+def wave() -> dict:
+    import main
+    conn = main.db()
+    main.warm_user_cache(conn)
+    main.warm_progress_cache(conn)
+    before = main.stats_get(conn, "all").get("created", 0)
+    by_shard: dict = {}
+    for uid in main._user_rows:
+        by_shard.setdefault(main.shard_of(uid), []).append((uid, "N", main.next_payload_id(conn, uid, "LORE")))
+    for i, items in by_shard.items():
+        main.write_wave_shard(i, items, 999, int(time.time()))
+    total = sum(r[0] for r in main.scatter(conn, "SELECT COUNT(*) FROM {anomalies}"))
+    return {"before": before, "after": main.stats_get(conn, "all").get("created", 0), "anomalies": total}
+
+def child(step: str):
+    result = {"snapshot": snapshot, "wave": wave}[step]()
+    print(json.dumps(result, ensure_ascii=False))
+
+def run(env, *args, ok=True) -> str:
+    out = subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True, cwd=HERE)
+    if ok and out.returncode != 0:
+        sys.exit(f"{' '.join(args)} failed:\n{out.stderr}")
+    if not ok and out.returncode == 0:
+        sys.exit(f"{' '.join(args)} should have failed")
+    return out.stdout if ok else out.stderr
+
+def step(env, name: str) -> dict:
+    return json.loads(run(env, os.path.abspath(__file__), "--child", name).strip().splitlines()[-1])
+
+def check(cond: bool, what: str):
+    if not cond:
+        sys.exit("FAIL: " + what)
+    print("ok  " + what)
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2])
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, BOT_TOKEN="1:check", COLD_START="0", CHECK_NOW=str(int(time.time())))
+        src = os.path.join(tmp, "one", "nez.db")
+        os.makedirs(os.path.dirname(src))
+        sys.path.insert(0, HERE)
+        raw = seed_baseline(src)
+
+        one = dict(env, DB_PATH=src, DB_SHARDS="1")
+        base = step(one, "snapshot")
+        check(base["version"] > 0 and base["shards"] == "1", "baseline schema migrated, layout recorded")
+        check(len(base["users"]) == USERS, "users preserved")
+        check(base["stats"].get("created") == raw["created"] and base["stats"].get("fixed") == raw["fixed"],
+              "stat counters backfilled from history")
+        check(all(a[2] for a in base["anomalies"]), "payload texts resolved through the catalog")
+        check(bool(base["progress"]), "progress backfilled")
+
+        err = run(dict(one, DB_SHARDS="2"), "-c", "import main; main.db()", ok=False)
+        check("reshard.py" in err and not os.path.exists(os.path.join(tmp, "one", "nez.s0.db")),
+              "mismatched DB_SHARDS refused before creating shard files")
+
+        three = os.path.join(tmp, "three", "nez.db")
+        run(env, "reshard.py", "--src", src, "--dst", three, "--shards", "3")
+        sharded = step(dict(env, DB_PATH=three, DB_SHARDS="3"), "snapshot")
+        check(sharded["shards"] == "3", "reshard recorded the new layout")
+        check({k: v for k, v in sharded.items() if k != "shards"} == {k: v for k, v in base.items() if k != "shards"},
+              "1 -> 3 shards: same content")
+
+        back = os.path.join(tmp, "back", "nez.db")
+        run(env, "reshard.py", "--src", three, "--src-shards", "3", "--dst", back, "--shards", "1")
+        again = step(dict(env, DB_PATH=back, DB_SHARDS="1"), "snapshot")
+        check(again == base, "3 -> 1 shards: same content")
+
+        w = step(dict(env, DB_PATH=three, DB_SHARDS="3"), "wave")
+        check(w["after"] - w["before"] == USERS and w["after"] == w["anomalies"],
+              "sharded wave writes counters with its anomalies")
+
+        written = step(dict(env, DB_PATH=three, DB_SHARDS="3"), "snapshot")
+        check(written["export_keys_unique"], "history export keys unique across shards")
+        merged = os.path.join(tmp, "merged", "nez.db")
+        run(env, "reshard.py", "--src", three, "--src-shards", "3", "--dst", merged, "--shards", "1")
+        after = step(dict(env, DB_PATH=merged, DB_SHARDS="1"), "snapshot")
+        check({k: v for k, v in after.items() if k != "shards"} == {k: v for k, v in written.items() if k != "shards"},
+              "written 3 shards -> 1: same content")
+        check(os.listdir(os.path.dirname(merged)) == ["nez.db"], "reshard leaves no temp files")
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,88 @@
 import os
+import sys
+import asyncio
+import signal
 import sqlite3
 import random
 import time
 import re
 import math
+import json
+import threading
+import importlib.util
+import logging
 from typing import Optional, Tuple
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.request import BaseRequest, HTTPXRequest
 
 # ================== CONFIG ==================
-TOKEN = os.environ.get("BOT_TOKEN")
-ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
-BASE_URL = os.environ.get("BASE_URL")
-PORT = int(os.environ.get("PORT", "10000"))
-
-DB_PATH = os.environ.get("DB_PATH", "/var/data/nez.db")
+# Несколько кампаний в одном процессе (TENANTS_FILE): модуль загружается по разу
+# на кампанию, TENANT с её переопределениями подставляется до исполнения модуля.
+TENANT: dict = globals().get("TENANT") or {}
+
+def env(key: str, default: Optional[str] = None) -> Optional[str]:
+    if key in TENANT:
+        return str(TENANT[key])
+    return os.environ.get(key, default)
+
+TOKEN = env("BOT_TOKEN")
+ADMIN_ID = int(env("ADMIN_ID", "0"))
+BASE_URL = env("BASE_URL")
+PORT = int(env("PORT", "10000"))
+
+DB_PATH = env("DB_PATH", "/var/data/nez.db")
+# >1: пользовательские таблицы разнесены по DB_SHARDS файлам рядом с DB_PATH (reshard.py)
+DB_SHARDS = int(env("DB_SHARDS", "1"))
+
+def max_shards() -> int:
+    # каждый шард — ATTACH на каждом соединении, а SQLite ограничивает их число
+    # (SQLITE_LIMIT_ATTACHED, обычно 10); один слот оставлен под src в reshard.py
+    conn = sqlite3.connect(":memory:")
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - 1
+    finally:
+        conn.close()
+
+if DB_SHARDS > max_shards():
+    raise RuntimeError(
+        f"DB_SHARDS={DB_SHARDS}: больше, чем SQLite может подключить к одному соединению "
+        f"(ATTACH), максимум {max_shards()}"
+    )
+# JSON {"NOCLASS": [...], "LORE": [...], "FRAGMENT": [...]} — свои тексты кампании
+SNIPPETS_FILE = env("SNIPPETS_FILE")
+# JSON-список кампаний: [{"name": ..., "BOT_TOKEN": ..., "DB_PATH": ..., "WEBHOOK_PATH": ...}, ...]
+TENANTS_FILE = os.environ.get("TENANTS_FILE")
+
+# Cold start (free plan: сервис засыпает, каждое пробуждение — холодный старт)
+COLD_START = env("COLD_START", "0") == "1"
+COLD_START_MAX_DEFER_SEC = int(env("COLD_START_MAX_DEFER_SEC", "30"))
+WEBHOOK_PATH = env("WEBHOOK_PATH", "telegram")
+
+# Outbound HTTP (Bot API). Два пула: ответы на апдейты и рассылки/волны пакетов
+HTTP_POOL_SIZE = int(env("HTTP_POOL_SIZE", "32"))
+HTTP_BULK_POOL_SIZE = int(env("HTTP_BULK_POOL_SIZE", "64"))
+BULK_RATE_PER_SEC = float(env("BULK_RATE_PER_SEC", "25"))  # Bot API: ~30 сообщений/с на бота
+HTTP_KEEPALIVE_SEC = float(env("HTTP_KEEPALIVE_SEC", "30"))
+HTTP2 = env("HTTP2", "0") == "1"  # нужен пакет h2, иначе остаётся HTTP/1.1
+HTTP_CONNECT_TIMEOUT = float(env("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(env("HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT = float(env("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(env("HTTP_POOL_TIMEOUT", "5"))
+HTTP_MEDIA_WRITE_TIMEOUT = float(env("HTTP_MEDIA_WRITE_TIMEOUT", "30"))
 
 # Scheduling
 TZ = ZoneInfo("Europe/Amsterdam")
@@ -32,11 +90,21 @@ PACKETS_PER_DAY = 3
 SCHEDULE_ANCHOR_HOUR = 0
 SCHEDULE_ANCHOR_MINUTE = 5
 
+# Click throttling (token bucket на пользователя + дедуп одинаковых callback)
+CLICK_RATE_PER_SEC = float(env("CLICK_RATE_PER_SEC", "0.5"))
+CLICK_BURST = int(env("CLICK_BURST", "4"))
+CLICK_DEDUP_SEC = float(env("CLICK_DEDUP_SEC", "1.5"))
+
+# Diagnostics (включаются админом, по умолчанию выключены)
+PROFILE_UPDATES = int(env("PROFILE_UPDATES", "50"))
+PROFILE_INTERVAL_MS = float(env("PROFILE_INTERVAL_MS", "5"))
+SLOW_SQL_MS = float(env("SLOW_SQL_MS", "50"))
+
 # Activity ranking (decay)
 ACTIVITY_HALF_LIFE_DAYS = 3  # активность “вдвое” тухнет за 3 дня
+RANK_POINTS_WEIGHT = 0.5  # вес очков в приоритете, остальное — активность (simulate.py)
 
-if not TOKEN:
-    raise RuntimeError("BOT_TOKEN not set")
+log = logging.getLogger(f"nez.{TENANT['name']}" if TENANT else "nez")
 
 # ================== STYLE ==================
 def hdr():
@@ -57,27 +125,181 @@ def access_level(points: int) -> str:
         return "D"
     return "E"
 
+# ================== HTTP ==================
+_bulk_request: Optional[HTTPXRequest] = None
+
+def make_request(pool_size: int) -> HTTPXRequest:
+    http_version = "2" if HTTP2 and importlib.util.find_spec("h2") else "1.1"
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        media_write_timeout=HTTP_MEDIA_WRITE_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=HTTP_KEEPALIVE_SEC,
+            )
+        },
+    )
+
+def bulk_bot(app: Application) -> Bot:
+    # отдельный Bot поверх своего пула: волна пакетов не забирает соединения у ответов
+    global _bulk_request
+    bot = app.bot_data.get("bulk_bot")
+    if bot is None:
+        if _bulk_request is None:
+            _bulk_request = make_request(HTTP_BULK_POOL_SIZE)
+        bot = Bot(app.bot.token, request=_bulk_request)
+        app.bot_data["bulk_bot"] = bot
+    return bot
+
+_bulk_next_slot = 0.0
+
+async def bulk_slot():
+    # равномерные слоты отправки: не больше BULK_RATE_PER_SEC в секунду на весь процесс-бот
+    global _bulk_next_slot
+    if BULK_RATE_PER_SEC <= 0:
+        return
+    now = time.monotonic()
+    slot = max(now, _bulk_next_slot)
+    _bulk_next_slot = slot + 1.0 / BULK_RATE_PER_SEC
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def bulk_pause(sec: float):
+    # 429 от Telegram: сдвигаем все следующие слоты, а не только повтор одного сообщения
+    global _bulk_next_slot
+    _bulk_next_slot = max(_bulk_next_slot, time.monotonic() + sec)
+
+async def send_bulk(bot: Bot, jobs) -> Tuple[int, int]:
+    # jobs: [(chat_id, text)]; параллельно в пределах пула и с лимитом скорости,
+    # после RetryAfter сообщение повторяется, пока не уйдёт
+    sem = asyncio.Semaphore(HTTP_BULK_POOL_SIZE)
+
+    async def one(chat_id, text) -> bool:
+        async with sem:
+            while True:
+                await bulk_slot()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text)
+                    return True
+                except RetryAfter as e:
+                    bulk_pause(float(e.retry_after))
+                except:
+                    return False
+
+    results = await asyncio.gather(*(one(c, t) for c, t in jobs))
+    sent = sum(1 for r in results if r)
+    return sent, len(results) - sent
+
+async def post_shutdown(app: Application):
+    global _bulk_request
+    if _bulk_request is not None:
+        await _bulk_request.shutdown()
+        _bulk_request = None
+
 # ================== DB ==================
+SCHEMA_VERSION = 9
+_schema_ready = False
+
+# Шардирование: users/user_activity/user_limits/anomalies/user_progress живут в
+# файле шарда пользователя (ATTACH как s0..sN-1), глобальные таблицы — в DB_PATH.
+# SQL к пользовательским таблицам пишется с {users}, {anomalies}, ... —
+# shard_sql(uid, sql) подставляет таблицы шарда пользователя, scatter() проходит по всем.
+USER_TABLES = ("users", "user_activity", "user_limits", "anomalies", "user_progress")
+# счётчики статистики лежат в шарде рядом с anomalies: пишутся в той же транзакции,
+# итог — сумма по шардам
+STAT_TABLES = ("stat_counters", "stat_day_users")
+# имена таблиц внутри самого файла шарда (соединение без ATTACH)
+LOCAL_TABLES = {name: name for name in USER_TABLES + STAT_TABLES}
+
+_shard_tables_cache: dict[Tuple[int, int], dict] = {}
+
+def shard_count() -> int:
+    return max(1, DB_SHARDS)
+
+def shard_of(uid: int) -> int:
+    if DB_SHARDS <= 1:
+        return 0
+    return ((int(uid) * 2654435761) & 0xFFFFFFFF) % DB_SHARDS
+
+def shard_path(i: int, base: Optional[str] = None, shards: Optional[int] = None) -> str:
+    base = base or DB_PATH
+    if (shards or DB_SHARDS) <= 1:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.s{i}{ext or '.db'}"
+
+def shard_tables(i: int) -> dict:
+    key = (DB_SHARDS, i)
+    names = _shard_tables_cache.get(key)
+    if names is None:
+        prefix = f"s{i}." if DB_SHARDS > 1 else ""
+        names = {t: prefix + t for t in USER_TABLES + STAT_TABLES}
+        names["p"] = prefix
+        names["shard"] = str(i)  # номер шарда литералом в SQL: id anomalies уникальны только внутри шарда
+        _shard_tables_cache[key] = names
+    return names
+
+def shard_sql(uid: int, sql: str) -> str:
+    return sql.format_map(shard_tables(shard_of(uid)))
+
+def scatter(conn, sql: str, params=()):
+    # тот же запрос по каждому шарду, строки подряд
+    for i in range(shard_count()):
+        yield from conn.execute(sql.format_map(shard_tables(i)), params)
+
+SHARDS_META_KEY = "db_shards"
+
+def check_shard_layout(conn):
+    # число шардов, с которым записаны данные, хранится в scheduler_meta;
+    # при несовпадении с DB_SHARDS запросы ушли бы в пустые файлы шардов
+    def has_table(name: str) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?", (name,)
+        ).fetchone() is not None
+
+    row = None
+    if has_table("scheduler_meta"):
+        row = conn.execute("SELECT v FROM main.scheduler_meta WHERE k=?", (SHARDS_META_KEY,)).fetchone()
+    if row:
+        stored = int(row[0])
+    elif has_table("users"):
+        stored = 1  # база до шардирования
+    else:
+        return  # новая база: запишет ensure_schema
+    if stored != shard_count():
+        raise RuntimeError(
+            f"{DB_PATH} записана с DB_SHARDS={stored}, а задано DB_SHARDS={DB_SHARDS}: "
+            f"перенесите данные через reshard.py или верните DB_SHARDS={stored}"
+        )
+
 def db():
-    conn = sqlite3.connect(DB_PATH)
+    global _schema_ready
+    if _slow_sql_on:
+        conn = sqlite3.connect(DB_PATH, factory=TracedConnection)
+    else:
+        conn = sqlite3.connect(DB_PATH)
     conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT UNIQUE,
-        points INTEGER DEFAULT 0,
-        created_at INTEGER
-    )""")
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS anomalies (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        kind TEXT,
-        payload TEXT,
-        status TEXT,
-        created_at INTEGER,
-        fixed_at INTEGER
-    )""")
+    if not _schema_ready:
+        check_shard_layout(conn)  # до ATTACH: не создавать пустые файлы шардов
+    if DB_SHARDS > 1:
+        for i in range(DB_SHARDS):
+            conn.execute("ATTACH DATABASE ? AS ?", (shard_path(i), f"s{i}"))
+    if not _schema_ready:
+        # полный DDL только если версия схемы не совпала; иначе одна PRAGMA на процесс
+        row = conn.execute("PRAGMA user_version").fetchone()
+        if not row or int(row[0]) != SCHEMA_VERSION:
+            ensure_schema(conn)
+        _schema_ready = True
+    return conn
+
+def ensure_schema(conn):
     conn.execute("""
     CREATE TABLE IF NOT EXISTS s_audio (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -98,18 +320,314 @@ def db():
         created_at INTEGER
     )""")
     conn.execute("""
-    CREATE TABLE IF NOT EXISTS user_limits (
+    CREATE TABLE IF NOT EXISTS payloads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category TEXT,
+        body TEXT UNIQUE
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS queue_rank (
+        rank INTEGER PRIMARY KEY,
+        user_id INTEGER UNIQUE,
+        username TEXT,
+        pri INTEGER
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_username_changes_status ON username_changes(status, id)")
+    conn.execute(
+        "INSERT OR IGNORE INTO scheduler_meta (k, v) VALUES (?, ?)",
+        (SHARDS_META_KEY, str(shard_count()))
+    )
+    migrated = []
+    for i in range(shard_count()):
+        if ensure_user_schema(conn, i):
+            migrated.append(i)
+    if DB_SHARDS > 1 and conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='stat_counters'"
+    ).fetchone():
+        migrate_stats_to_shards(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if DB_SHARDS > 1:
+        for i in range(DB_SHARDS):
+            conn.execute(f"PRAGMA s{i}.user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    for i in migrated:
+        conn.execute(f"VACUUM {shard_tables(i)['p'][:-1] or 'main'}")  # вернуть место, освобождённое дублями текста
+
+def ensure_user_schema(conn, i: int) -> bool:
+    t = shard_tables(i)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['users']} (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT UNIQUE,
+        points INTEGER DEFAULT 0,
+        created_at INTEGER
+    )""")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['anomalies']} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        kind TEXT,
+        payload TEXT,
+        status TEXT,
+        created_at INTEGER,
+        fixed_at INTEGER
+    )""")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['user_limits']} (
         user_id INTEGER PRIMARY KEY,
         username_change_used INTEGER DEFAULT 0
     )""")
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS user_activity (
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['user_activity']} (
         user_id INTEGER PRIMARY KEY,
         score REAL DEFAULT 0,
         updated_at INTEGER
     )""")
-    conn.commit()
-    return conn
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['stat_counters']} (
+        bucket TEXT,
+        name TEXT,
+        v INTEGER DEFAULT 0,
+        PRIMARY KEY (bucket, name)
+    )""")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {t['stat_day_users']} (
+        day TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (day, user_id)
+    )""")
+    if _add_column_if_missing(conn, t["anomalies"], "wave", "INTEGER"):
+        backfill_stats(conn, i)
+    migrated = False
+    if _add_column_if_missing(conn, t["anomalies"], "payload_id", "INTEGER"):
+        migrated = migrate_payloads(conn, i)
+    if not conn.execute(
+        f"SELECT 1 FROM {t['p']}sqlite_master WHERE type='table' AND name='user_progress'"
+    ).fetchone():
+        conn.execute(f"""
+        CREATE TABLE {t['user_progress']} (
+            user_id INTEGER PRIMARY KEY,
+            seen BLOB
+        )""")
+        backfill_progress(conn, i)
+    if _add_column_if_missing(conn, t["user_activity"], "activity_key", "REAL"):
+        migrate_activity_keys(conn, i)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {t['p']}idx_activity_key ON user_activity(activity_key)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {t['p']}idx_users_points ON users(points)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {t['p']}idx_anomalies_user ON anomalies(user_id, status)")
+    return migrated
+
+# ================== DIAGNOSTICS ==================
+# Медленные SQL: пока трассировка выключена, db() отдаёт обычный sqlite3.Connection.
+_slow_sql_on = False
+
+class TracedCursor(sqlite3.Cursor):
+    # время запроса = execute + все fetch/итерация до исчерпания курсора
+    # (или до закрытия/сборки, если строки дочитаны не все)
+    _sql = None
+    _params = None
+    _spent = 0.0
+
+    def _timed(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._spent += time.perf_counter() - t0
+
+    def _done(self):
+        if self._sql is None:
+            return
+        sql, params, spent = self._sql, self._params, self._spent
+        self._sql = None
+        _check_slow_sql(self.connection, sql, params, spent)
+
+    def execute(self, sql, params=()):
+        self._done()
+        self._sql, self._params, self._spent = sql, params, 0.0
+        self._timed(super().execute, sql, params)
+        if self.description is None:
+            self._done()  # не SELECT: строк не будет
+        return self
+
+    def executemany(self, sql, seq):
+        self._done()
+        self._sql, self._params, self._spent = sql, None, 0.0
+        self._timed(super().executemany, sql, seq)
+        self._done()
+        return self
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._done()
+            raise
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._done()
+        return row
+
+    def fetchmany(self, size=None):
+        n = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, n)
+        if len(rows) < n:
+            self._done()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._done()
+        return rows
+
+    def close(self):
+        self._done()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._done()
+        except:
+            pass
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+def toggle_slow_sql():
+    global _slow_sql_on
+    _slow_sql_on = not _slow_sql_on
+
+def _check_slow_sql(conn, sql: str, params, elapsed: float):
+    ms = elapsed * 1000
+    if ms < SLOW_SQL_MS:
+        return
+    stmt = " ".join(sql.split())
+    plan = ""
+    if params is not None and stmt.split(" ", 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            plan = " | ".join(str(r[-1]) for r in rows)
+        except sqlite3.Error:
+            pass
+    log.warning("slow sql %.1f ms: %s%s", ms, stmt, f" [plan: {plan}]" if plan else "")
+
+# Профилировщик: поток раз в PROFILE_INTERVAL_MS снимает стеки потока event loop
+# и рабочих потоков asyncio.to_thread (write_wave_shard и пр.), на выходе —
+# collapsed stacks (формат flamegraph.pl / speedscope), корень — имя потока.
+_prof_mode: Optional[str] = None   # None | "updates" | "spawn"
+_prof_left = 0
+_prof_thread = None
+_prof_stop = None
+_prof_counts: dict[str, int] = {}
+
+def profiler_start():
+    global _prof_thread, _prof_stop
+
+    if _prof_thread is not None:
+        return
+    loop_ident = threading.get_ident()
+    stop = threading.Event()
+    _prof_counts.clear()
+
+    def targets() -> dict:
+        # пул asyncio.to_thread — потоки "asyncio_N" executor'а по умолчанию
+        found = {loop_ident: "loop"}
+        for t in threading.enumerate():
+            if t.name.startswith("asyncio_"):
+                found[t.ident] = "to_thread"
+        return found
+
+    def run():
+        while not stop.wait(PROFILE_INTERVAL_MS / 1000.0):
+            frames = sys._current_frames()
+            for ident, root in targets().items():
+                frame = frames.get(ident)
+                if frame is None or frame.f_code.co_name in ("select", "_worker"):
+                    continue  # event loop / рабочий поток простаивает
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = root + ";" + ";".join(reversed(stack))
+                _prof_counts[key] = _prof_counts.get(key, 0) + 1
+
+    _prof_stop = stop
+    _prof_thread = threading.Thread(target=run, name="nez-profiler", daemon=True)
+    _prof_thread.start()
+
+def profiler_stop() -> str:
+    global _prof_thread, _prof_stop, _prof_mode
+    if _prof_thread is not None:
+        _prof_stop.set()
+        _prof_thread.join()
+    _prof_thread = None
+    _prof_stop = None
+    _prof_mode = None
+    lines = [f"{k} {v}" for k, v in sorted(_prof_counts.items(), key=lambda kv: -kv[1])]
+    return "\n".join(lines) + "\n"
+
+def profiler_arm(mode: str):
+    global _prof_mode, _prof_left
+    _prof_mode = mode
+    _prof_left = PROFILE_UPDATES
+    if mode == "updates":
+        profiler_start()
+
+async def send_profile(bot: Bot, label: str):
+    if ADMIN_ID == 0:
+        profiler_stop()
+        return
+    data = profiler_stop().encode("utf-8")
+    stamp = datetime.now(TZ).strftime("%Y%m%d_%H%M%S")
+    try:
+        await bot.send_document(ADMIN_ID, document=data, filename=f"profile_{label}_{stamp}.txt")
+    except:
+        pass
+
+async def profiler_after_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _prof_left
+    if _prof_mode != "updates":
+        return
+    _prof_left -= 1
+    if _prof_left <= 0:
+        await send_profile(context.bot, "updates")
+
+def diag_kb(uid):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Профиль: {PROFILE_UPDATES} апдейтов", callback_data="ADMIN_PROF_UPD")],
+        [InlineKeyboardButton("Профиль: следующая волна пакетов", callback_data="ADMIN_PROF_SPAWN")],
+        [InlineKeyboardButton(
+            f"Медленные SQL (>{SLOW_SQL_MS:g} мс): {'выкл' if _slow_sql_on else 'вкл'}",
+            callback_data="ADMIN_SLOWSQL"
+        )],
+    ] + [list(r) for r in menu(uid).inline_keyboard])
+
+def diag_text() -> str:
+    prof = {"updates": f"идёт ({_prof_left} апдейтов осталось)", "spawn": "ждёт волну пакетов"}.get(_prof_mode, "выключен")
+    return (
+        hdr() +
+        "Диагностика\n\n"
+        f"Профилировщик: {prof}\n"
+        f"Трассировка медленных SQL: {'включена' if _slow_sql_on else 'выключена'}"
+    )
+
+def _add_column_if_missing(conn, table: str, column: str, decl: str) -> bool:
+    schema, _, name = table.rpartition(".")
+    cols = {r[1] for r in conn.execute(f"PRAGMA {schema or 'main'}.table_info({name})")}
+    if column in cols:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
 
 def get_meta(conn, key: str) -> Optional[str]:
     row = conn.execute("SELECT v FROM scheduler_meta WHERE k=?", (key,)).fetchone()
@@ -159,157 +677,330 @@ def freeze_banner(conn) -> str:
         return f"\n\n[СТАТУС] ОЧЕРЕДЬ ЗАМОРОЖЕНА\nФиксация: {stamp}"
     return "\n\n[СТАТУС] ОЧЕРЕДЬ ЗАМОРОЖЕНА"
 
+# ================== USER CACHE ==================
+# Полная копия users/user_limits/user_activity в памяти (write-through).
+# Пишет в эти таблицы только этот процесс, поэтому кэш не расходится с БД.
+_user_rows: dict[int, tuple] = {}                  # uid -> (user_id, username, points, created_at)
+_user_by_name: dict[str, int] = {}                 # username -> uid
+_user_limits: dict[int, int] = {}                  # uid -> username_change_used
+_user_activity: dict[int, Optional[float]] = {}    # uid -> activity_key
+_user_cache_ready = False
+
+def warm_user_cache(conn):
+    global _user_cache_ready
+    if _user_cache_ready:
+        return
+    for r in scatter(conn, "SELECT user_id, username, points, created_at FROM {users}"):
+        _user_rows[int(r[0])] = (int(r[0]), r[1], int(r[2] or 0), int(r[3] or 0))
+        if r[1] is not None:
+            _user_by_name[r[1]] = int(r[0])
+    for uid, used in scatter(conn, "SELECT user_id, username_change_used FROM {user_limits}"):
+        _user_limits[int(uid)] = int(used or 0)
+    for uid, key in scatter(conn, "SELECT user_id, activity_key FROM {user_activity}"):
+        _user_activity[int(uid)] = None if key is None else float(key)
+    _user_cache_ready = True
+
+def username_taken(conn, name: str) -> bool:
+    warm_user_cache(conn)
+    return name in _user_by_name
+
 # ================== ACTIVITY ==================
+# Активность хранится как activity_key = log2(score) + updated_at / half_life:
+# значение на момент t равно 2 ** (activity_key - t / half_life).
+# Порядок по activity_key не меняется со временем, поэтому его можно индексировать.
+def _half_life_sec() -> float:
+    return ACTIVITY_HALF_LIFE_DAYS * 24 * 3600
+
+def activity_key(score: float, ts: int) -> Optional[float]:
+    half_life_sec = _half_life_sec()
+    if score <= 0 or half_life_sec <= 0:
+        return None
+    return math.log2(score) + ts / half_life_sec
+
+def activity_at(key: Optional[float], now_ts: int) -> float:
+    half_life_sec = _half_life_sec()
+    if key is None or half_life_sec <= 0:
+        return 0.0
+    return 2.0 ** (key - now_ts / half_life_sec)
+
 def ensure_activity_row(conn, uid: int):
+    warm_user_cache(conn)
+    if uid in _user_activity:
+        return
     conn.execute(
-        "INSERT OR IGNORE INTO user_activity (user_id, score, updated_at) VALUES (?, 0, ?)",
+        shard_sql(uid, "INSERT OR IGNORE INTO {user_activity} (user_id, score, updated_at) VALUES (?, 0, ?)"),
         (uid, int(time.time()))
     )
     conn.commit()
+    _user_activity[uid] = None
 
-def get_activity(conn, uid: int) -> Tuple[float, int]:
+def get_activity_key(conn, uid: int) -> Optional[float]:
     ensure_activity_row(conn, uid)
-    row = conn.execute(
-        "SELECT score, updated_at FROM user_activity WHERE user_id=?",
-        (uid,)
-    ).fetchone()
-    if not row:
-        return 0.0, int(time.time())
-    return float(row[0] or 0.0), int(row[1] or int(time.time()))
-
-def _decay_multiplier(dt_sec: int) -> float:
-    half_life_sec = ACTIVITY_HALF_LIFE_DAYS * 24 * 3600
-    if half_life_sec <= 0:
-        return 0.0
-    return 0.5 ** (dt_sec / half_life_sec)
+    return _user_activity[uid]
 
 def get_sync_now(conn, uid: int, now_ts: Optional[int] = None) -> float:
     if now_ts is None:
         now_ts = int(time.time())
-    score, last_ts = get_activity(conn, uid)
-    dt = max(0, now_ts - last_ts)
-    decay = _decay_multiplier(dt)
-    return float(score) * decay
+    return activity_at(get_activity_key(conn, uid), now_ts)
 
 def update_activity(conn, uid: int, pts: int, now_ts: int):
-    score, last_ts = get_activity(conn, uid)
-    dt = max(0, now_ts - last_ts)
-
-    decay = _decay_multiplier(dt)
-    new_score = score * decay + float(pts)
+    new_score = get_sync_now(conn, uid, now_ts) + float(pts)
+    key = activity_key(new_score, now_ts)
 
     conn.execute(
-        "UPDATE user_activity SET score=?, updated_at=? WHERE user_id=?",
-        (new_score, now_ts, uid)
+        shard_sql(uid, "UPDATE {user_activity} SET score=?, updated_at=?, activity_key=? WHERE user_id=?"),
+        (new_score, now_ts, key, uid)
     )
     conn.commit()
+    _user_activity[uid] = key
+
+def top_active(conn, k: int):
+    # индексный обход по activity_key в каждом шарде, слияние k лучших
+    rows = scatter(conn, """
+        SELECT a.user_id, u.username, a.activity_key
+        FROM {user_activity} a
+        JOIN {users} u ON u.user_id = a.user_id
+        WHERE a.activity_key IS NOT NULL
+        ORDER BY a.activity_key DESC
+        LIMIT ?
+    """, (k,))
+    return sorted(rows, key=lambda r: -r[2])[:k]
+
+def activity_rank(conn, uid: int) -> int:
+    key = get_activity_key(conn, uid)
+    if key is None:
+        rows = scatter(conn, "SELECT COUNT(*) FROM {user_activity} WHERE activity_key IS NOT NULL")
+    else:
+        rows = scatter(conn, "SELECT COUNT(*) FROM {user_activity} WHERE activity_key > ?", (key,))
+    return sum(int(r[0]) for r in rows) + 1
+
+def migrate_activity_keys(conn, i: int = 0):
+    t = shard_tables(i)
+    rows = conn.execute(f"SELECT user_id, score, updated_at FROM {t['user_activity']}").fetchall()
+    conn.executemany(
+        f"UPDATE {t['user_activity']} SET activity_key=? WHERE user_id=?",
+        [(activity_key(float(score or 0.0), int(ts or 0)), uid) for uid, score, ts in rows]
+    )
 
 # ================== USERS ==================
 def get_user(conn, uid):
-    return conn.execute(
-        "SELECT user_id, username, points, created_at FROM users WHERE user_id=?",
-        (uid,)
-    ).fetchone()
+    warm_user_cache(conn)
+    return _user_rows.get(uid)
 
 def create_user(conn, uid, name):
+    warm_user_cache(conn)
+    now_ts = int(time.time())
     conn.execute(
-        "INSERT INTO users VALUES (?, ?, 0, ?)",
-        (uid, name, int(time.time()))
+        shard_sql(uid, "INSERT INTO {users} VALUES (?, ?, 0, ?)"),
+        (uid, name, now_ts)
     )
     conn.execute(
-        "INSERT OR IGNORE INTO user_limits (user_id, username_change_used) VALUES (?, 0)",
+        shard_sql(uid, "INSERT OR IGNORE INTO {user_limits} (user_id, username_change_used) VALUES (?, 0)"),
         (uid,)
     )
     conn.execute(
-        "INSERT OR IGNORE INTO user_activity (user_id, score, updated_at) VALUES (?, 0, ?)",
-        (uid, int(time.time()))
+        shard_sql(uid, "INSERT OR IGNORE INTO {user_activity} (user_id, score, updated_at) VALUES (?, 0, ?)"),
+        (uid, now_ts)
     )
     conn.commit()
+    _user_rows[uid] = (uid, name, 0, now_ts)
+    _user_by_name[name] = uid
+    _user_limits.setdefault(uid, 0)
+    _user_activity.setdefault(uid, None)
+    rank_append(conn, uid, name)
 
 def add_points(conn, uid, pts):
     frozen, _ = is_frozen(conn)
     if frozen:
         return  # заморозка: никаких изменений очков/активности
 
+    warm_user_cache(conn)
     now_ts = int(time.time())
     conn.execute(
-        "UPDATE users SET points = points + ? WHERE user_id=?",
+        shard_sql(uid, "UPDATE {users} SET points = points + ? WHERE user_id=?"),
         (pts, uid)
     )
     conn.commit()
+    row = _user_rows.get(uid)
+    if row:
+        _user_rows[uid] = (uid, row[1], row[2] + int(pts), row[3])
     update_activity(conn, uid, pts, now_ts)
+    mark_rank_dirty()
 
-def ordered_users(conn):
+def ranking_now(conn) -> int:
     # если заморожено — фиксируем "сейчас" на момент фиксации
     frozen, fts = is_frozen(conn)
-    now_ts = int(fts) if (frozen and fts) else int(time.time())
+    return int(fts) if (frozen and fts) else int(time.time())
 
-    rows = conn.execute("""
-        SELECT u.user_id, u.username, u.points, u.created_at,
-               COALESCE(a.score, 0) AS activity_score,
-               COALESCE(a.updated_at, ?) AS activity_updated_at
-        FROM users u
-        LEFT JOIN user_activity a ON a.user_id = u.user_id
-    """, (now_ts,)).fetchall()
+def _rank_norms(max_points: int, max_sync: float) -> Tuple[float, float]:
+    max_p = math.log1p(max(0, int(max_points)))
+    max_a = math.log1p(max(0.0, float(max_sync)))
+    return (max_p if max_p > 0 else 1.0), (max_a if max_a > 0 else 1.0)
 
-    if not rows:
-        return []
+def _blend(points: int, sync_now: float, max_p: float, max_a: float,
+           points_weight: Optional[float] = None) -> float:
+    w = RANK_POINTS_WEIGHT if points_weight is None else points_weight
+    p_norm = math.log1p(max(0, int(points))) / max_p
+    a_norm = math.log1p(max(0.0, sync_now)) / max_a
+    return w * p_norm + (1.0 - w) * a_norm
 
-    eff_sync = []
-    for r in rows:
-        score = float(r[4] or 0.0)
-        last_ts = int(r[5] or now_ts)
-        dt = max(0, now_ts - last_ts)
-        decay = _decay_multiplier(dt)
-        eff_sync.append(score * decay)
+def ordered_users(conn):
+    now_ts = ranking_now(conn)
 
-    points_logs = [math.log1p(max(0, int(r[2]))) for r in rows]
-    act_logs = [math.log1p(max(0.0, float(s))) for s in eff_sync]
+    rows = list(scatter(conn, """
+        SELECT u.user_id, u.username, u.points, u.created_at, a.activity_key
+        FROM {users} u
+        LEFT JOIN {user_activity} a ON a.user_id = u.user_id
+    """))
 
-    max_p = max(points_logs) if points_logs else 1.0
-    max_a = max(act_logs) if act_logs else 1.0
+    if not rows:
+        return []
 
-    if max_p <= 0:
-        max_p = 1.0
-    if max_a <= 0:
-        max_a = 1.0
+    eff_sync = [activity_at(r[4], now_ts) for r in rows]
+    max_p, max_a = _rank_norms(max(int(r[2]) for r in rows), max(eff_sync))
 
     scored = []
     for idx, r in enumerate(rows):
-        uid, username, points, created_at, _, _ = r
-        sync_now = float(eff_sync[idx])
-
-        p_norm = math.log1p(max(0, int(points))) / max_p
-        a_norm = math.log1p(max(0.0, sync_now)) / max_a
-
-        blended = 0.5 * p_norm + 0.5 * a_norm
-
+        uid, username, points, created_at, _ = r
+        blended = _blend(points, eff_sync[idx], max_p, max_a)
         pri_int = int(round(blended * 1000))
-        scored.append((uid, username, int(points), int(created_at), sync_now, blended, pri_int))
+        scored.append((uid, username, int(points), int(created_at), blended, pri_int))
 
-    scored.sort(key=lambda x: (-x[5], -x[2], x[3]))
-    return [(s[0], s[1], s[6]) for s in scored]
+    # user_id последним: при шардах порядок строк из scatter не совпадает с порядком по ключу
+    scored.sort(key=lambda x: (-x[4], -x[2], x[3], x[0]))
+    return [(s[0], s[1], s[5]) for s in scored]
 
 def pri_of_user(conn, uid: int) -> int:
-    rows = ordered_users(conn)
-    for r in rows:
-        if r[0] == uid:
-            return int(r[2])
-    return 0
+    # O(1): свои очки/activity_key + два MAX по индексам, без полного ранжирования
+    user = get_user(conn, uid)
+    if not user:
+        return 0
+    now_ts = ranking_now(conn)
+    max_points = max((r[0] or 0 for r in scatter(conn, "SELECT MAX(points) FROM {users}")), default=0)
+    keys = [r[0] for r in scatter(conn, "SELECT MAX(activity_key) FROM {user_activity}") if r[0] is not None]
+    max_key = max(keys) if keys else None
+    max_p, max_a = _rank_norms(max_points, activity_at(max_key, now_ts))
+    sync_now = activity_at(get_activity_key(conn, uid), now_ts)
+    return int(round(_blend(user[2], sync_now, max_p, max_a) * 1000))
+
+# ================== RANK (MATERIALIZED) ==================
+# queue_rank — снимок ordered_users(): пересчитывается джобом, когда что-то
+# поменялось (или раз в RANK_MAX_AGE_SEC из-за затухания активности).
+# Позиция, соседи и страницы рейтинга — чтение диапазона по rank.
+# Пересчёт полный, в рабочем потоке на своём соединении (rebuild_rank);
+# изменения очков инкрементально в снимок не вносятся — только через него.
+RANK_PAGE_SIZE = 10
+RANK_REFRESH_SEC = 30
+RANK_MAX_AGE_SEC = 600
+
+_rank_dirty = True
+_rank_checked = False
+_rank_refreshed_at = 0.0
+_rank_building = False
+_rank_lock = threading.Lock()
+
+def mark_rank_dirty():
+    global _rank_dirty
+    _rank_dirty = True
+
+def refresh_rank(conn):
+    global _rank_dirty, _rank_checked, _rank_refreshed_at, _rank_building
+    # флаг снимаем до чтения: пометка, пришедшая во время пересчёта, не потеряется
+    _rank_dirty = False
+    _rank_building = True
+    try:
+        rows = ordered_users(conn)
+        conn.execute("DELETE FROM queue_rank")
+        conn.executemany(
+            "INSERT INTO queue_rank (rank, user_id, username, pri) VALUES (?, ?, ?, ?)",
+            [(i, uid, name, pri) for i, (uid, name, pri) in enumerate(rows, 1)]
+        )
+        conn.commit()
+    except:
+        _rank_dirty = True
+        raise
+    finally:
+        _rank_building = False
+    _rank_checked = True
+    _rank_refreshed_at = time.time()
+
+def rebuild_rank():
+    # для asyncio.to_thread: event loop не ждёт полного пересчёта
+    with _rank_lock:
+        conn = db()
+        try:
+            refresh_rank(conn)
+        finally:
+            conn.close()
+
+def ensure_rank(conn):
+    # снимок с прошлого запуска годится, если в нём все пользователи
+    global _rank_checked
+    if _rank_checked:
+        return
+    n_rank = conn.execute("SELECT COUNT(*) FROM queue_rank").fetchone()[0]
+    n_users = sum(int(r[0]) for r in scatter(conn, "SELECT COUNT(*) FROM {users}"))
+    if n_rank != n_users:
+        refresh_rank(conn)
+    _rank_checked = True
+
+async def rank_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    if _rank_dirty or time.time() - _rank_refreshed_at > RANK_MAX_AGE_SEC:
+        await asyncio.to_thread(rebuild_rank)
+
+def rank_append(conn, uid: int, name: str):
+    # новый пользователь: 0 очков и 0 активности, created_at самый поздний — ровно в конец
+    ensure_rank(conn)
+    if rank_of(conn, uid) is not None:
+        return
+    conn.execute(
+        "INSERT INTO queue_rank (rank, user_id, username, pri) "
+        "SELECT COALESCE(MAX(rank), 0) + 1, ?, ?, 0 FROM queue_rank",
+        (uid, name)
+    )
+    conn.commit()
+    if _rank_building:
+        mark_rank_dirty()  # идущий пересчёт мог прочитать users до этого пользователя
+
+def rank_total(conn) -> int:
+    ensure_rank(conn)
+    row = conn.execute("SELECT MAX(rank) FROM queue_rank").fetchone()
+    return int(row[0] or 0)
+
+def rank_of(conn, uid: int) -> Optional[int]:
+    ensure_rank(conn)
+    row = conn.execute("SELECT rank FROM queue_rank WHERE user_id=?", (uid,)).fetchone()
+    return int(row[0]) if row else None
+
+def rank_page(conn, after: int = 0, before: Optional[int] = None, size: int = RANK_PAGE_SIZE):
+    # keyset по rank: (rank, user_id, username, pri)
+    ensure_rank(conn)
+    if before is not None:
+        rows = conn.execute(
+            "SELECT rank, user_id, username, pri FROM queue_rank WHERE rank < ? ORDER BY rank DESC LIMIT ?",
+            (before, size)
+        ).fetchall()
+        return rows[::-1]
+    return conn.execute(
+        "SELECT rank, user_id, username, pri FROM queue_rank WHERE rank > ? ORDER BY rank LIMIT ?",
+        (after, size)
+    ).fetchall()
 
 def queue_position(conn, uid) -> Tuple[int, int]:
-    ids = [r[0] for r in ordered_users(conn)]
-    total = len(ids)
-    return (ids.index(uid) + 1, total) if uid in ids else (total + 1, total)
+    total = rank_total(conn)
+    pos = rank_of(conn, uid)
+    return (pos, total) if pos is not None else (total + 1, total)
 
 def queue_neighbors(conn, uid, window: int = 2):
-    rows = ordered_users(conn)
-    ids = [r[0] for r in rows]
-    if uid not in ids:
+    pos = rank_of(conn, uid)
+    if pos is None:
         return [], []
-    i = ids.index(uid)
-    above = rows[max(0, i - window): i]
-    below = rows[i + 1: i + 1 + window]
+    rows = conn.execute(
+        "SELECT rank, user_id, username, pri FROM queue_rank WHERE rank BETWEEN ? AND ? ORDER BY rank",
+        (pos - window, pos + window)
+    ).fetchall()
+    above = [(r[1], r[2], r[3]) for r in rows if r[0] < pos]
+    below = [(r[1], r[2], r[3]) for r in rows if r[0] > pos]
     return above, below
 
 # ================== S AUDIO ==================
@@ -317,19 +1008,14 @@ def add_s_audio(conn, fid: str) -> bool:
     try:
         conn.execute("INSERT INTO s_audio (file_id) VALUES (?)", (fid,))
         conn.commit()
-        return True
     except sqlite3.IntegrityError:
         return False
+    catalog_add(conn, "S", fid)
+    return True
 
 def count_s_audio(conn) -> int:
-    row = conn.execute("SELECT COUNT(*) FROM s_audio").fetchone()
-    return int(row[0]) if row else 0
-
-def random_s_audio(conn) -> Optional[str]:
-    row = conn.execute(
-        "SELECT file_id FROM s_audio ORDER BY RANDOM() LIMIT 1"
-    ).fetchone()
-    return row[0] if row else None
+    warm_payload_cache(conn)
+    return len(_payload_ids_by_category.get("S", []))
 
 # ================== ANOMALIES ==================
 NOCLASS_TEXT = [
@@ -358,28 +1044,180 @@ FRAGMENT_SNIPPETS = [
     "Пакет расшифрован: Получен фрагмент №05 типа FRAGMENT\nНочью под белым пламенем\nлежим убиты, ранены.\nПоцелуй на прощание —\nтвои слёзы — моя вина...",
 ]
 
-def create_anomaly(conn, uid, kind, payload):
-    conn.execute("""
-    INSERT INTO anomalies (user_id, kind, payload, status, created_at)
-    VALUES (?, ?, ?, 'NEW', ?)
-    """, (uid, kind, payload, int(time.time())))
+if SNIPPETS_FILE:
+    with open(SNIPPETS_FILE, encoding="utf-8") as f:
+        _snippets = json.load(f)
+    NOCLASS_TEXT = _snippets.get("NOCLASS", NOCLASS_TEXT)
+    LORE_SNIPPETS = _snippets.get("LORE", LORE_SNIPPETS)
+    FRAGMENT_SNIPPETS = _snippets.get("FRAGMENT", FRAGMENT_SNIPPETS)
+
+# ================== PAYLOAD CATALOG ==================
+# Тексты фрагментов и file_id S-аудио хранятся один раз в payloads,
+# anomalies ссылаются на них по payload_id. Каталог целиком в памяти.
+PAYLOAD_CATEGORIES = (
+    ("FRAGMENT", FRAGMENT_SNIPPETS),
+    ("LORE", LORE_SNIPPETS),
+    ("NOCLASS", NOCLASS_TEXT),
+)
+
+_payload_text: dict[int, str] = {}
+_payload_id: dict[str, int] = {}
+_payload_ids_by_category: dict[str, list[int]] = {}
+_payload_cache_ready = False
+
+def seed_payloads(conn):
+    conn.executemany(
+        "INSERT OR IGNORE INTO payloads (category, body) VALUES (?, ?)",
+        [(cat, body) for cat, items in PAYLOAD_CATEGORIES for body in items]
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO payloads (category, body) SELECT 'S', file_id FROM s_audio"
+    )
+
+def warm_payload_cache(conn):
+    global _payload_cache_ready
+    if _payload_cache_ready:
+        return
+    seed_payloads(conn)
     conn.commit()
+    for pid, category, body in conn.execute("SELECT id, category, body FROM payloads ORDER BY id"):
+        _cache_payload(int(pid), category, body)
+    _payload_cache_ready = True
+
+def _cache_payload(pid: int, category: str, body: str):
+    _payload_text[pid] = body
+    _payload_id[body] = pid
+    _payload_ids_by_category.setdefault(category, []).append(pid)
+
+def catalog_add(conn, category: str, body: str) -> int:
+    warm_payload_cache(conn)
+    pid = _payload_id.get(body)
+    if pid is not None:
+        return pid
+    conn.execute("INSERT OR IGNORE INTO payloads (category, body) VALUES (?, ?)", (category, body))
+    conn.commit()
+    pid = int(conn.execute("SELECT id FROM payloads WHERE body=?", (body,)).fetchone()[0])
+    _cache_payload(pid, category, body)
+    return pid
+
+def payload_text(conn, pid: Optional[int]) -> Optional[str]:
+    if pid is None:
+        return None
+    warm_payload_cache(conn)
+    body = _payload_text.get(pid)
+    if body is None:
+        row = conn.execute("SELECT category, body FROM payloads WHERE id=?", (pid,)).fetchone()
+        if row:
+            _cache_payload(pid, row[0], row[1])
+            body = row[1]
+    return body
+
+def snippet_ids(conn, category: str) -> list[int]:
+    # id в порядке списков в коде
+    warm_payload_cache(conn)
+    items = dict(PAYLOAD_CATEGORIES).get(category)
+    if items is None:
+        return _payload_ids_by_category.get(category, [])
+    return [_payload_id[body] for body in items]
+
+def random_payload_id(conn, category: str) -> Optional[int]:
+    ids = snippet_ids(conn, category)
+    return random.choice(ids) if ids else None
+
+def migrate_payloads(conn, i: int = 0) -> bool:
+    # старые строки: payload-текст -> payload_id, сам текст обнуляется
+    t = shard_tables(i)
+    seed_payloads(conn)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO payloads (category, body)
+        SELECT DISTINCT CASE kind WHEN 'S' THEN 'S' ELSE 'OTHER' END, payload
+        FROM {t['anomalies']}
+        WHERE payload IS NOT NULL
+    """)
+    cur = conn.execute(f"""
+        UPDATE {t['anomalies']}
+        SET payload_id = (SELECT p.id FROM payloads p WHERE p.body = payload),
+            payload = NULL
+        WHERE payload IS NOT NULL
+    """)
+    return cur.rowcount > 0
+
+# ================== PROGRESSION ==================
+# Какие payload_id пользователь уже получал — битсет (бит = payload_id),
+# в БД хранится BLOB'ом, в памяти — int. Выбор без повторов, пока категория не собрана.
+PROGRESS_CATEGORIES = ("FRAGMENT", "LORE", "S")
+
+_user_seen: dict[int, int] = {}
+_progress_cache_ready = False
+
+def _bits_to_blob(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+def _category_mask(conn, category: str) -> int:
+    mask = 0
+    for pid in snippet_ids(conn, category):
+        mask |= 1 << pid
+    return mask
+
+def warm_progress_cache(conn):
+    global _progress_cache_ready
+    if _progress_cache_ready:
+        return
+    for uid, blob in scatter(conn, "SELECT user_id, seen FROM {user_progress}"):
+        _user_seen[int(uid)] = int.from_bytes(blob or b"", "little")
+    _progress_cache_ready = True
+
+def next_payload_id(conn, uid: int, category: str) -> Optional[int]:
+    warm_progress_cache(conn)
+    seen = _user_seen.get(uid, 0)
+    ids = snippet_ids(conn, category)
+    fresh = [pid for pid in ids if not (seen >> pid) & 1]
+    pool = fresh or ids  # всё собрано — дальше любые
+    if not pool:
+        return None
+    pid = random.choice(pool)
+    _user_seen[uid] = seen | (1 << pid)
+    return pid
+
+PROGRESS_UPSERT = (
+    "INSERT INTO {user_progress} (user_id, seen) VALUES (?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET seen=excluded.seen"
+)
+
+def collection(conn, uid: int, category: str) -> Tuple[int, int]:
+    warm_progress_cache(conn)
+    mask = _category_mask(conn, category)
+    return bin(_user_seen.get(uid, 0) & mask).count("1"), bin(mask).count("1")
+
+def backfill_progress(conn, i: int = 0):
+    t = shard_tables(i)
+    seen: dict[int, int] = {}
+    for uid, pid in conn.execute(
+        f"SELECT DISTINCT user_id, payload_id FROM {t['anomalies']} WHERE payload_id IS NOT NULL"
+    ):
+        seen[int(uid)] = seen.get(int(uid), 0) | (1 << int(pid))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {t['user_progress']} (user_id, seen) VALUES (?, ?)",
+        [(uid, _bits_to_blob(bits)) for uid, bits in seen.items()]
+    )
+
+ANOMALY_INSERT = """
+    INSERT INTO {anomalies} (user_id, kind, payload_id, status, created_at, wave)
+    VALUES (?, ?, ?, 'NEW', ?, ?)
+"""
+ANOMALY_EXPIRE = "UPDATE {anomalies} SET status='EXPIRED' WHERE user_id=? AND status IN ('NEW','FIXED')"
 
 def get_active_anomaly(conn, uid):
-    return conn.execute("""
-    SELECT id, kind, payload, status, fixed_at, created_at
-    FROM anomalies
+    row = conn.execute(shard_sql(uid, """
+    SELECT id, kind, payload_id, status, fixed_at, created_at, wave
+    FROM {anomalies}
     WHERE user_id=? AND status IN ('NEW','FIXED')
     ORDER BY created_at DESC
     LIMIT 1
-    """, (uid,)).fetchone()
-
-def expire_active_anomalies(conn, uid):
-    conn.execute(
-        "UPDATE anomalies SET status='EXPIRED' WHERE user_id=? AND status IN ('NEW','FIXED')",
-        (uid,)
-    )
-    conn.commit()
+    """), (uid,)).fetchone()
+    if not row:
+        return None
+    return (row[0], row[1], payload_text(conn, row[2])) + tuple(row[3:])
 
 # ================== SCORE (FAST CONFIRM) ==================
 def confirm_points(elapsed_sec: int) -> int:
@@ -399,6 +1237,143 @@ def confirm_points(elapsed_sec: int) -> int:
         return 2
     return 1
 
+# ================== STATS ==================
+# Счётчики обновляются в момент выдачи/подтверждения/расшифровки пакета,
+# экран статистики читает их по первичному ключу без сканов anomalies/users.
+WAVE_SEQ_KEY = "wave_seq"
+LATENCY_BINS = (5, 10, 20, 30, 45, 60, 120)  # те же пороги, что в confirm_points
+
+def next_wave(conn) -> int:
+    wave = int(get_meta(conn, WAVE_SEQ_KEY) or 0) + 1
+    set_meta(conn, WAVE_SEQ_KEY, str(wave))
+    return wave
+
+def _day_key(ts: int) -> str:
+    return datetime.fromtimestamp(ts, TZ).strftime("%Y-%m-%d")
+
+def _stat_buckets(wave: Optional[int], ts: int) -> list[str]:
+    buckets = ["all", "day:" + _day_key(ts)]
+    if wave:
+        buckets.append(f"wave:{wave}")
+    return buckets
+
+def _latency_name(elapsed_sec: int) -> str:
+    for b in LATENCY_BINS:
+        if elapsed_sec <= b:
+            return f"lat_{b}"
+    return "lat_inf"
+
+STAT_UPSERT = (
+    "INSERT INTO {stat_counters} (bucket, name, v) VALUES (?, ?, ?) "
+    "ON CONFLICT(bucket, name) DO UPDATE SET v = v + excluded.v"
+)
+
+def stats_add(conn, t: dict, buckets, name: str, n: int = 1):
+    # без commit: пишется в той же транзакции, что и сам пакет (t — таблицы его шарда)
+    conn.executemany(STAT_UPSERT.format_map(t), [(b, name, n) for b in buckets])
+
+def _mark_day_active(conn, t: dict, uid: int, ts: int):
+    day = _day_key(ts)
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO {stat_day_users} (day, user_id) VALUES (?, ?)".format_map(t), (day, uid)
+    )
+    if cur.rowcount == 1:
+        stats_add(conn, t, ["day:" + day], "active_users")
+
+def record_created(conn, t: dict, wave: Optional[int], n: int, ts: int):
+    stats_add(conn, t, _stat_buckets(wave, ts), "created", n)
+
+def record_fixed(conn, wave: Optional[int], uid: int, elapsed_sec: int, ts: int):
+    t = shard_tables(shard_of(uid))
+    buckets = _stat_buckets(wave, ts)
+    stats_add(conn, t, buckets, "fixed")
+    stats_add(conn, t, buckets, _latency_name(elapsed_sec))
+    _mark_day_active(conn, t, uid, ts)
+
+def record_done(conn, wave: Optional[int], uid: int, ts: int):
+    t = shard_tables(shard_of(uid))
+    stats_add(conn, t, _stat_buckets(wave, ts), "done")
+    _mark_day_active(conn, t, uid, ts)
+
+def stats_get(conn, bucket: str) -> dict:
+    out: dict[str, int] = {}
+    for name, v in scatter(conn, "SELECT name, v FROM {stat_counters} WHERE bucket=?", (bucket,)):
+        out[name] = out.get(name, 0) + int(v)
+    return out
+
+def backfill_stats(conn, i: int = 0):
+    # разовый проход по истории при миграции; дальше только инкременты
+    t = shard_tables(i)
+    rows = conn.execute(f"SELECT user_id, status, created_at, fixed_at FROM {t['anomalies']}").fetchall()
+    for uid, status, created_at, fixed_at in rows:
+        if created_at:
+            record_created(conn, t, None, 1, int(created_at))
+        if fixed_at and status in ("FIXED", "DONE"):
+            record_fixed(conn, None, int(uid), max(0, int(fixed_at) - int(created_at or fixed_at)), int(fixed_at))
+        if fixed_at and status == "DONE":
+            record_done(conn, None, int(uid), int(fixed_at))
+
+def migrate_stats_to_shards(conn):
+    # до v9 счётчики лежали в основном файле: итоги — в s0, активные за день — в шард пользователя
+    conn.executemany(
+        STAT_UPSERT.format_map(shard_tables(0)),
+        conn.execute("SELECT bucket, name, v FROM main.stat_counters").fetchall()
+    )
+    for day, uid in conn.execute("SELECT day, user_id FROM main.stat_day_users").fetchall():
+        conn.execute(
+            shard_sql(uid, "INSERT OR IGNORE INTO {stat_day_users} (day, user_id) VALUES (?, ?)"), (day, uid)
+        )
+    conn.execute("DROP TABLE main.stat_counters")
+    conn.execute("DROP TABLE main.stat_day_users")
+
+def _pct(a: int, b: int) -> str:
+    return f"{(100.0 * a / b):.1f}%" if b else "—"
+
+def stats_text(conn) -> str:
+    now_ts = int(time.time())
+    wave = int(get_meta(conn, WAVE_SEQ_KEY) or 0)
+    w = stats_get(conn, f"wave:{wave}") if wave else {}
+    d = stats_get(conn, "day:" + _day_key(now_ts))
+    a = stats_get(conn, "all")
+    warm_user_cache(conn)
+
+    text = hdr() + "Статистика\n\n"
+    text += f"Пользователей: {len(_user_rows)}\n\n"
+
+    if wave:
+        created, fixed = w.get("created", 0), w.get("fixed", 0)
+        text += (
+            f"Волна #{wave}\n"
+            f"Выдано: {created}\n"
+            f"Подтверждено: {fixed} ({_pct(fixed, created)})\n"
+            f"Расшифровано: {w.get('done', 0)}\n"
+            "Время подтверждения:\n"
+        )
+        prev = 0
+        for b in LATENCY_BINS:
+            text += f"  {prev}–{b} с: {w.get(f'lat_{b}', 0)}\n"
+            prev = b
+        text += f"  >{prev} с: {w.get('lat_inf', 0)}\n\n"
+
+    top = top_active(conn, 5)
+    if top:
+        text += "Самые активные сейчас:\n"
+        for i, (_, username, key) in enumerate(top, 1):
+            text += f"{i}. {username} — {activity_at(key, now_ts):.1f}\n"
+        text += "\n"
+
+    text += (
+        f"Сегодня\n"
+        f"Подтверждено: {d.get('fixed', 0)}\n"
+        f"Расшифровано: {d.get('done', 0)}\n"
+        f"Активных пользователей: {d.get('active_users', 0)}\n\n"
+        f"Всего\n"
+        f"Выдано: {a.get('created', 0)}\n"
+        f"Подтверждено: {a.get('fixed', 0)} ({_pct(a.get('fixed', 0), a.get('created', 0))})\n"
+        f"Расшифровано: {a.get('done', 0)}"
+    )
+    return text
+
 # ================== USERNAME CHANGE ==================
 USERNAME_RE_REG = re.compile(r"^[a-zA-Z0-9_.-]{3,20}$")
 USERNAME_RE_CHANGE = re.compile(r"^[A-Za-zА-Яа-яЁё0-9 _\.\-]{3,20}$")
@@ -409,27 +1384,28 @@ WAIT_BROADCAST = set()
 S_MODE = set()
 
 def ensure_limits_row(conn, uid: int):
+    warm_user_cache(conn)
+    if uid in _user_limits:
+        return
     conn.execute(
-        "INSERT OR IGNORE INTO user_limits (user_id, username_change_used) VALUES (?, 0)",
+        shard_sql(uid, "INSERT OR IGNORE INTO {user_limits} (user_id, username_change_used) VALUES (?, 0)"),
         (uid,)
     )
     conn.commit()
+    _user_limits[uid] = 0
 
 def username_change_used(conn, uid: int) -> int:
     ensure_limits_row(conn, uid)
-    row = conn.execute(
-        "SELECT username_change_used FROM user_limits WHERE user_id=?",
-        (uid,)
-    ).fetchone()
-    return int(row[0]) if row else 0
+    return _user_limits[uid]
 
 def inc_username_change_used(conn, uid: int):
     ensure_limits_row(conn, uid)
     conn.execute(
-        "UPDATE user_limits SET username_change_used = username_change_used + 1 WHERE user_id=?",
+        shard_sql(uid, "UPDATE {user_limits} SET username_change_used = username_change_used + 1 WHERE user_id=?"),
         (uid,)
     )
     conn.commit()
+    _user_limits[uid] += 1
 
 def create_rename_request(conn, uid: int, old_name: str, new_name: str) -> int:
     cur = conn.execute(
@@ -440,23 +1416,121 @@ def create_rename_request(conn, uid: int, old_name: str, new_name: str) -> int:
     conn.commit()
     return int(cur.lastrowid)
 
-def get_rename_request(conn, rid: int):
+# Заявки на смену ID разбираются пачками из инбокса админа: решения по странице
+# применяются одной транзакцией, конфликты имён решаются по индексу в памяти.
+RENAME_PAGE_SIZE = 8
+RENAME_DECLINE: set[int] = set()   # id заявок, помеченных в инбоксе на отклонение
+
+RENAME_OK_TEXT = "Запрос подтвержден."
+RENAME_NO_TEXT = "Запрос отклонён."
+
+def pending_rename_count(conn) -> int:
+    row = conn.execute("SELECT COUNT(*) FROM username_changes WHERE status='PENDING'").fetchone()
+    return int(row[0] or 0)
+
+def rename_page(conn, after: int = 0, before: Optional[int] = None):
+    if before is not None:
+        rows = conn.execute(
+            "SELECT id, user_id, old_username, new_username FROM username_changes "
+            "WHERE status='PENDING' AND id < ? ORDER BY id DESC LIMIT ?",
+            (before, RENAME_PAGE_SIZE)
+        ).fetchall()
+        return rows[::-1]
     return conn.execute(
-        "SELECT id, user_id, old_username, new_username, status FROM username_changes WHERE id=?",
-        (rid,)
-    ).fetchone()
-
-def set_rename_status(conn, rid: int, status: str):
-    conn.execute("UPDATE username_changes SET status=? WHERE id=?", (status, rid))
-    conn.commit()
-
-def rename_kb(req_id: int):
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("Подтвердить", callback_data=f"RENAME_OK:{req_id}"),
-            InlineKeyboardButton("Отклонить", callback_data=f"RENAME_NO:{req_id}"),
-        ]
+        "SELECT id, user_id, old_username, new_username FROM username_changes "
+        "WHERE status='PENDING' AND id > ? ORDER BY id LIMIT ?",
+        (after, RENAME_PAGE_SIZE)
+    ).fetchall()
+
+def apply_rename_decisions(conn, decisions) -> Tuple[int, int, list]:
+    # decisions: [(rid, approve)]; -> (подтверждено, отклонено, [(uid, текст)] для send_bulk)
+    warm_user_cache(conn)
+    approve = dict(decisions)
+    if not approve:
+        return 0, 0, []
+    marks = ",".join("?" * len(approve))
+    rows = conn.execute(
+        f"SELECT id, user_id, new_username FROM username_changes "
+        f"WHERE status='PENDING' AND id IN ({marks}) ORDER BY id",
+        list(approve)
+    ).fetchall()
+
+    taken = dict(_user_by_name)   # имя -> uid с учётом уже принятых в этой пачке решений
+    renamed: dict[int, str] = {}  # uid -> итоговое имя
+    statuses = []
+    notify = []
+    for rid, target_uid, new_name in rows:
+        ok = approve[rid] and target_uid in _user_rows and new_name not in taken
+        if ok:
+            taken.pop(renamed.get(target_uid, _user_rows[target_uid][1]), None)
+            taken[new_name] = target_uid
+            renamed[target_uid] = new_name
+        statuses.append(("APPROVED" if ok else "DECLINED", rid))
+        notify.append((target_uid, RENAME_OK_TEXT if ok else RENAME_NO_TEXT))
+
+    # в два шага в одной транзакции: сначала имена всех переименованных освобождаются (NULL),
+    # потом ставятся итоговые — имя может перейти от одного пользователя к другому в той же
+    # пачке, и порядок заявок тут ничего не гарантирует (у одного uid их может быть несколько)
+    try:
+        for target_uid in renamed:
+            conn.execute(shard_sql(target_uid, "UPDATE {users} SET username=NULL WHERE user_id=?"), (target_uid,))
+        for target_uid, new_name in renamed.items():
+            conn.execute(shard_sql(target_uid, "UPDATE {users} SET username=? WHERE user_id=?"), (new_name, target_uid))
+        conn.executemany(
+            "UPDATE queue_rank SET username=? WHERE user_id=?",
+            [(new_name, target_uid) for target_uid, new_name in renamed.items()]
+        )
+        conn.executemany("UPDATE username_changes SET status=? WHERE id=?", statuses)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+    for target_uid, new_name in renamed.items():
+        row = _user_rows[target_uid]
+        if _user_by_name.get(row[1]) == target_uid:
+            del _user_by_name[row[1]]
+        _user_rows[target_uid] = (target_uid, new_name, row[2], row[3])
+        _user_by_name[new_name] = target_uid
+    RENAME_DECLINE.difference_update(approve)
+
+    approved = sum(1 for status, _ in statuses if status == "APPROVED")
+    return approved, len(statuses) - approved, notify
+
+def rename_inbox_screen(conn, uid: int, rows, note: str = ""):
+    total = pending_rename_count(conn)
+    text = hdr() + note + f"Заявки на смену ID: {total}\n\n"
+    if not rows:
+        text += "Новых заявок нет."
+        return text, menu(uid)
+
+    for n, (rid, target_uid, old_name, new_name) in enumerate(rows, 1):
+        mark = " ✗" if rid in RENAME_DECLINE else ""
+        text += f"{n}. {target_uid}: {old_name} → {new_name}{mark}\n"
+    text += "\nОтмеченные ✗ будут отклонены, остальные — подтверждены."
+
+    first, last = rows[0][0], rows[-1][0]
+    toggles = [
+        InlineKeyboardButton(
+            f"{n}. {'✗' if rid in RENAME_DECLINE else '✓'} {new_name}",
+            callback_data=f"RN_T:{rid}:{first}"
+        )
+        for n, (rid, _, _, new_name) in enumerate(rows, 1)
+    ]
+    kb = [toggles[k:k + 2] for k in range(0, len(toggles), 2)]
+    kb.append([
+        InlineKeyboardButton("✅ Применить", callback_data=f"RN_OK:{first}:{last}"),
+        InlineKeyboardButton("✗ Отклонить все", callback_data=f"RN_NO:{first}:{last}"),
     ])
+    nav = []
+    if conn.execute(
+        "SELECT 1 FROM username_changes WHERE status='PENDING' AND id < ? LIMIT 1", (first,)
+    ).fetchone():
+        nav.append(InlineKeyboardButton("◀", callback_data=f"RN<:{first}"))
+    if len(rows) == RENAME_PAGE_SIZE:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"RN>:{last}"))
+    kb.append(nav)
+    return text, InlineKeyboardMarkup(kb + [list(r) for r in menu(uid).inline_keyboard])
 
 # ================== UI ==================
 def menu(uid):
@@ -482,8 +1556,71 @@ def menu(uid):
         rows.append([InlineKeyboardButton("🧊 Заморозка очереди", callback_data="ADMIN_FREEZE_TOGGLE")])
         rows.append([InlineKeyboardButton("＋ Добавить S", callback_data="ADD_S")])
         rows.append([InlineKeyboardButton("⚠ Запустить пакет", callback_data="ADMIN_PUSH")])
+        rows.append([InlineKeyboardButton("📝 Заявки на смену ID", callback_data="RN")])
+        rows.append([InlineKeyboardButton("📊 Статистика", callback_data="ADMIN_STATS")])
+        rows.append([InlineKeyboardButton("📤 Экспорт", callback_data="ADMIN_EXPORT")])
+        rows.append([InlineKeyboardButton("🩺 Диагностика", callback_data="ADMIN_DIAG")])
     return InlineKeyboardMarkup(rows)
 
+# ================== CLICK THROTTLE ==================
+HEAVY_CALLBACKS = {"A", "Q", "TOP"}
+CLICK_STATE_MAX = 20000
+
+_click_buckets: dict[int, Tuple[float, float]] = {}   # uid -> (tokens, ts)
+_click_last: dict[Tuple[int, str], float] = {}        # (uid, data) -> ts
+
+def _prune_click_state(now: float):
+    idle = max(CLICK_DEDUP_SEC, CLICK_BURST / CLICK_RATE_PER_SEC if CLICK_RATE_PER_SEC > 0 else 0)
+    for k in [k for k, ts in _click_last.items() if now - ts > CLICK_DEDUP_SEC]:
+        del _click_last[k]
+    for k in [k for k, (_, ts) in _click_buckets.items() if now - ts > idle]:
+        del _click_buckets[k]
+
+def click_verdict(uid: int, data: str, now: Optional[float] = None) -> str:
+    # "ok" | "dup" | "throttled"; всё в памяти, без БД
+    if now is None:
+        now = time.monotonic()
+    if len(_click_last) > CLICK_STATE_MAX or len(_click_buckets) > CLICK_STATE_MAX:
+        _prune_click_state(now)
+
+    # окно дедупа отсчитывается от последнего пропущенного нажатия, а не от любого:
+    # иначе частые тапы продлевали бы окно бесконечно
+    key = (uid, data)
+    last = _click_last.get(key)
+    if last is not None and now - last < CLICK_DEDUP_SEC:
+        return "dup"
+
+    if data not in HEAVY_CALLBACKS or uid == ADMIN_ID:
+        _click_last[key] = now
+        return "ok"
+
+    tokens, ts = _click_buckets.get(uid, (float(CLICK_BURST), now))
+    tokens = min(float(CLICK_BURST), tokens + (now - ts) * CLICK_RATE_PER_SEC)
+    if tokens < 1.0:
+        _click_buckets[uid] = (tokens, now)
+        return "throttled"
+    _click_buckets[uid] = (tokens - 1.0, now)
+    _click_last[key] = now
+    return "ok"
+
+def leaderboard_screen(conn, uid, rows):
+    total = rank_total(conn)
+    if not rows or rows[0][0] == 1:
+        text = hdr() + "Обладатели первых позиций в очереди:\n\n"
+    else:
+        text = hdr() + f"Очередь: позиции {rows[0][0]}–{rows[-1][0]} из {total}\n\n"
+    for rank, r_uid, username, pri in rows:
+        text += f"{rank}. {username} — {pri}" + (" ◀" if r_uid == uid else "") + "\n"
+    text += freeze_banner(conn)
+
+    nav = []
+    if rows and rows[0][0] > 1:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"TOP<:{rows[0][0]}"))
+    nav.append(InlineKeyboardButton("Моя страница", callback_data="TOP_ME"))
+    if rows and rows[-1][0] < total:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"TOP>:{rows[-1][0]}"))
+    return text, InlineKeyboardMarkup([nav] + [list(r) for r in menu(uid).inline_keyboard])
+
 # ================== START ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     conn = db()
@@ -523,18 +1660,12 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if uid == ADMIN_ID and uid in WAIT_BROADCAST:
         WAIT_BROADCAST.discard(uid)
 
-        rows = conn.execute("SELECT user_id FROM users").fetchall()
-        user_ids = [int(r[0]) for r in rows]
-
-        sent = 0
-        failed = 0
+        user_ids = [int(r[0]) for r in scatter(conn, "SELECT user_id FROM {users}")]
 
-        for to_uid in user_ids:
-            try:
-                await context.bot.send_message(chat_id=to_uid, text=txt)
-                sent += 1
-            except:
-                failed += 1
+        sent, failed = await send_bulk(
+            bulk_bot(context.application),
+            [(to_uid, txt) for to_uid in user_ids]
+        )
 
         await update.message.reply_text(
             f"Рассылка завершена.\nОтправлено: {sent}\nОшибок: {failed}",
@@ -549,7 +1680,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Неверный формат. Попробуйте снова.")
             return
 
-        if conn.execute("SELECT 1 FROM users WHERE username=?", (name,)).fetchone():
+        if username_taken(conn, name):
             await update.message.reply_text("ID уже занят.")
             return
 
@@ -587,15 +1718,13 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Неверный формат. Попробуйте снова.")
             return
 
-        if conn.execute("SELECT 1 FROM users WHERE username=?", (new_name,)).fetchone():
+        if username_taken(conn, new_name):
             await update.message.reply_text("ID уже занят.")
             return
 
         old_name = user[1]
         inc_username_change_used(conn, uid)
-        used_after = username_change_used(conn, uid)
-
-        rid = create_rename_request(conn, uid, old_name, new_name)
+        create_rename_request(conn, uid, old_name, new_name)
         WAIT_RENAME.discard(uid)
 
         await update.message.reply_text(
@@ -603,18 +1732,15 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=menu(uid)
         )
 
-        if ADMIN_ID != 0:
+        # админу — одно уведомление, когда инбокс перестал быть пустым, а не сообщение на заявку
+        if ADMIN_ID != 0 and pending_rename_count(conn) == 1:
             try:
                 await context.bot.send_message(
                     chat_id=ADMIN_ID,
-                    text=(
-                        "Запрос на смену ID\n\n"
-                        f"Пользователь: {uid}\n"
-                        f"Текущий ID: {old_name}\n"
-                        f"Новый ID: {new_name}\n"
-                        f"Попытка: {used_after}/3"
-                    ),
-                    reply_markup=rename_kb(rid)
+                    text="Новые заявки на смену ID.",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("📝 Открыть заявки", callback_data="RN")]
+                    ])
                 )
             except:
                 pass
@@ -623,8 +1749,17 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ================== CALLBACKS ==================
 async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
     uid = q.from_user.id
+
+    verdict = click_verdict(uid, q.data or "")
+    if verdict == "dup":
+        await q.answer()
+        return
+    if verdict == "throttled":
+        await q.answer("Слишком частые запросы. Подождите несколько секунд.")
+        return
+
+    await q.answer()
     conn = db()
 
     if q.data == "HELP":
@@ -645,6 +1780,7 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = get_user(conn, uid)
         pos, total = queue_position(conn, uid)
         pri = pri_of_user(conn, uid)
+        act = activity_rank(conn, uid)
 
         above, below = queue_neighbors(conn, uid, window=2)
         neigh = ""
@@ -657,24 +1793,34 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 for r in below:
                     neigh += f"▼ {r[1]} — {r[2]}\n"
 
+        frag_seen, frag_total = collection(conn, uid, "FRAGMENT")
+        lore_seen, lore_total = collection(conn, uid, "LORE")
+
         await q.edit_message_text(
             hdr() +
             f"ID: {user[1]}\n"
             f"Позиция: {pos}/{total}\n"
             f"Индекс допуска: {pri}\n"
-            f"Уровень доступа: {access_level(int(user[2]))}"
+            f"Место по активности: {act}/{total}\n"
+            f"Уровень доступа: {access_level(int(user[2]))}\n"
+            f"Фрагменты: {frag_seen}/{frag_total} · Протоколы: {lore_seen}/{lore_total}"
             + neigh
             + freeze_banner(conn),
             reply_markup=menu(uid)
         )
 
-    elif q.data == "TOP":
-        rows = ordered_users(conn)[:10]
-        text = hdr() + "Обладатели первых позиций в очереди:\n\n"
-        for i, r in enumerate(rows, 1):
-            text += f"{i}. {r[1]} — {r[2]}\n"
-        text += freeze_banner(conn)
-        await q.edit_message_text(text, reply_markup=menu(uid))
+    elif q.data == "TOP" or q.data.startswith("TOP>:") or q.data.startswith("TOP<:") or q.data == "TOP_ME":
+        if q.data.startswith("TOP>:"):
+            rows = rank_page(conn, after=int(q.data.split(":", 1)[1]))
+        elif q.data.startswith("TOP<:"):
+            rows = rank_page(conn, before=int(q.data.split(":", 1)[1]))
+        elif q.data == "TOP_ME":
+            pos = rank_of(conn, uid) or 1
+            rows = rank_page(conn, after=(pos - 1) // RANK_PAGE_SIZE * RANK_PAGE_SIZE)
+        else:
+            rows = rank_page(conn)
+        text, kb = leaderboard_screen(conn, uid, rows)
+        await q.edit_message_text(text, reply_markup=kb)
 
     elif q.data == "A":
         frozen, _ = is_frozen(conn)
@@ -694,7 +1840,7 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.edit_message_text("Вы еще не получили новый пакет данных от NEZ Project.", reply_markup=menu(uid))
             return
 
-        aid, kind, payload, status, fixed_at, created_at = a
+        aid, kind, payload, status, fixed_at, created_at, wave = a
 
         if status == "NEW":
             now = int(time.time())
@@ -702,9 +1848,10 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pts = confirm_points(elapsed)
 
             conn.execute(
-                "UPDATE anomalies SET status='FIXED', fixed_at=? WHERE id=?",
+                shard_sql(uid, "UPDATE {anomalies} SET status='FIXED', fixed_at=? WHERE id=?"),
                 (now, aid)
             )
+            record_fixed(conn, wave, uid, elapsed, now)
             conn.commit()
 
             add_points(conn, uid, pts)
@@ -725,7 +1872,8 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await context.bot.send_message(uid, payload)
                     add_points(conn, uid, 2)
 
-                conn.execute("UPDATE anomalies SET status='DONE' WHERE id=?", (aid,))
+                conn.execute(shard_sql(uid, "UPDATE {anomalies} SET status='DONE' WHERE id=?"), (aid,))
+                record_done(conn, wave, uid, int(time.time()))
                 conn.commit()
 
                 await q.edit_message_text(
@@ -775,6 +1923,7 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif q.data == "ADMIN_FREEZE_TOGGLE" and uid == ADMIN_ID:
         frozen, _ = is_frozen(conn)
         set_frozen(conn, not frozen)
+        await asyncio.to_thread(rebuild_rank)
 
         frozen2, ts2 = is_frozen(conn)
         if frozen2:
@@ -795,53 +1944,86 @@ async def on_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text(msg, reply_markup=menu(uid))
 
     # ================== ADMIN MODERATION (RENAME) ==================
-    elif q.data.startswith("RENAME_OK:") and uid == ADMIN_ID:
+    elif (q.data == "RN" or q.data[:3] in ("RN<", "RN>")) and uid == ADMIN_ID:
+        if q.data.startswith("RN>:"):
+            rows = rename_page(conn, after=int(q.data[4:]))
+        elif q.data.startswith("RN<:"):
+            rows = rename_page(conn, before=int(q.data[4:]))
+        else:
+            rows = rename_page(conn)
+        text, kb = rename_inbox_screen(conn, uid, rows)
+        await q.edit_message_text(text, reply_markup=kb)
+
+    elif q.data.startswith("RN_T:") and uid == ADMIN_ID:
+        _, rid, first = q.data.split(":")
+        rid = int(rid)
+        if rid in RENAME_DECLINE:
+            RENAME_DECLINE.discard(rid)
+        else:
+            RENAME_DECLINE.add(rid)
+        text, kb = rename_inbox_screen(conn, uid, rename_page(conn, after=int(first) - 1))
+        await q.edit_message_text(text, reply_markup=kb)
+
+    elif (q.data.startswith("RN_OK:") or q.data.startswith("RN_NO:")) and uid == ADMIN_ID:
+        _, first, last = q.data.split(":")
+        decline_all = q.data.startswith("RN_NO:")
+        rids = [
+            int(r[0]) for r in conn.execute(
+                "SELECT id FROM username_changes WHERE status='PENDING' AND id BETWEEN ? AND ?",
+                (int(first), int(last))
+            )
+        ]
+        try:
+            approved, declined, notify = apply_rename_decisions(
+                conn, [(rid, not decline_all and rid not in RENAME_DECLINE) for rid in rids]
+            )
+            note = f"Подтверждено: {approved}, отклонено: {declined}.\n"
+        except sqlite3.Error:
+            log.exception("rename batch %s-%s failed", first, last)
+            approved, declined, notify = 0, 0, []
+            note = "Не удалось применить решения, ничего не изменено.\n"
+        text, kb = rename_inbox_screen(conn, uid, rename_page(conn), note=note)
+        await q.edit_message_text(text, reply_markup=kb)
+        # уведомления — через лимит скорости send_bulk, в фоне: экран админа не ждёт очередь
+        context.application.create_task(send_bulk(bulk_bot(context.application), notify))
+
+    # кнопки из старых сообщений о заявках (до инбокса)
+    elif (q.data.startswith("RENAME_OK:") or q.data.startswith("RENAME_NO:")) and uid == ADMIN_ID:
         rid = int(q.data.split(":", 1)[1])
-        req = get_rename_request(conn, rid)
-        if not req:
-            await q.edit_message_text("Запрос не найден.", reply_markup=menu(uid))
-            return
-        _, target_uid, old_name, new_name, status = req
-        if status != "PENDING":
+        approved, declined, notify = apply_rename_decisions(conn, [(rid, q.data.startswith("RENAME_OK:"))])
+        if not notify:
             await q.edit_message_text("Запрос уже обработан.", reply_markup=menu(uid))
             return
+        await q.edit_message_text("Подтверждено." if approved else "Отклонено.", reply_markup=menu(uid))
+        context.application.create_task(send_bulk(bulk_bot(context.application), notify))
 
-        if conn.execute("SELECT 1 FROM users WHERE username=?", (new_name,)).fetchone():
-            set_rename_status(conn, rid, "DECLINED")
-            await q.edit_message_text("Отклонено: ID уже занят.", reply_markup=menu(uid))
-            try:
-                await context.bot.send_message(chat_id=target_uid, text="Запрос отклонён.")
-            except:
-                pass
-            return
+    # ================== ADMIN: STATS ==================
+    elif q.data == "ADMIN_STATS" and uid == ADMIN_ID:
+        await q.edit_message_text(stats_text(conn), reply_markup=menu(uid))
 
-        conn.execute("UPDATE users SET username=? WHERE user_id=?", (new_name, target_uid))
-        conn.commit()
-        set_rename_status(conn, rid, "APPROVED")
-
-        await q.edit_message_text("Подтверждено.", reply_markup=menu(uid))
+    # ================== ADMIN: EXPORT ==================
+    elif q.data == "ADMIN_EXPORT" and uid == ADMIN_ID:
+        await q.edit_message_text("Экспорт запущен.", reply_markup=menu(uid))
         try:
-            await context.bot.send_message(chat_id=target_uid, text="Запрос подтвержден.")
+            await export_to_admin(context, uid)
         except:
-            pass
+            await context.bot.send_message(uid, "Ошибка экспорта.")
 
-    elif q.data.startswith("RENAME_NO:") and uid == ADMIN_ID:
-        rid = int(q.data.split(":", 1)[1])
-        req = get_rename_request(conn, rid)
-        if not req:
-            await q.edit_message_text("Запрос не найден.", reply_markup=menu(uid))
-            return
-        _, target_uid, old_name, new_name, status = req
-        if status != "PENDING":
-            await q.edit_message_text("Запрос уже обработан.", reply_markup=menu(uid))
-            return
+    # ================== ADMIN: DIAGNOSTICS ==================
+    elif q.data == "ADMIN_DIAG" and uid == ADMIN_ID:
+        await q.edit_message_text(diag_text(), reply_markup=diag_kb(uid))
 
-        set_rename_status(conn, rid, "DECLINED")
-        await q.edit_message_text("Отклонено.", reply_markup=menu(uid))
-        try:
-            await context.bot.send_message(chat_id=target_uid, text="Запрос отклонён.")
-        except:
-            pass
+    elif q.data == "ADMIN_PROF_UPD" and uid == ADMIN_ID:
+        profiler_arm("updates")
+        await q.edit_message_text(diag_text(), reply_markup=diag_kb(uid))
+
+    elif q.data == "ADMIN_PROF_SPAWN" and uid == ADMIN_ID:
+        profiler_arm("spawn")
+        await q.edit_message_text(diag_text(), reply_markup=diag_kb(uid))
+
+    elif q.data == "ADMIN_SLOWSQL" and uid == ADMIN_ID:
+        toggle_slow_sql()
+        await q.edit_message_text(diag_text(), reply_markup=diag_kb(uid))
 
     # ================== ADMIN: S AUDIO ==================
     elif q.data == "ADD_S" and uid == ADMIN_ID:
@@ -882,6 +2064,36 @@ async def on_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ================== SPAWN ==================
 async def spawn_anomalies(context: ContextTypes.DEFAULT_TYPE):
+    if _prof_mode != "spawn":
+        await spawn_wave(context)
+        return
+    profiler_start()
+    try:
+        await spawn_wave(context)
+    finally:
+        await send_profile(context.bot, "spawn")
+
+def write_wave_shard(i: int, items, wave: int, ts: int):
+    # своё соединение к файлу шарда: шарды пишутся параллельно, каждый одной транзакцией
+    # вместе со своими счётчиками "created"
+    t = LOCAL_TABLES
+    conn = sqlite3.connect(shard_path(i), timeout=30)
+    try:
+        conn.executemany(ANOMALY_EXPIRE.format_map(t), [(uid,) for uid, _, _ in items])
+        conn.executemany(
+            ANOMALY_INSERT.format_map(t),
+            [(uid, kind, pid, ts, wave) for uid, kind, pid in items]
+        )
+        conn.executemany(
+            PROGRESS_UPSERT.format_map(t),
+            [(uid, _bits_to_blob(_user_seen.get(uid, 0))) for uid, _, _ in items]
+        )
+        record_created(conn, t, wave, len(items), ts)
+        conn.commit()
+    finally:
+        conn.close()
+
+async def spawn_wave(context: ContextTypes.DEFAULT_TYPE):
     conn = db()
 
     frozen, _ = is_frozen(conn)
@@ -889,35 +2101,121 @@ async def spawn_anomalies(context: ContextTypes.DEFAULT_TYPE):
         return  # заморозка: пакеты не выдаём
 
     users = ordered_users(conn)
+    wave = next_wave(conn)
+    conn.commit()
+    ts = int(time.time())
+    by_shard: dict[int, list] = {}
+    notify = []
 
+    # выбор пакетов — в памяти, запись — scatter по шардам
     for uid, _, _ in users:
-        expire_active_anomalies(conn, uid)
-
         r = random.random()
+        kind, pid = "N", None
 
         if r < 0.40:
-            fid = random_s_audio(conn)
-            if fid:
-                create_anomaly(conn, uid, "S", fid)
-                try:
-                    await context.bot.send_message(uid, "Новый пакет данных от NEZ Project доступен.")
-                except:
-                    pass
-                continue
-
-        if r < 0.60:
-            payload = random.choice(FRAGMENT_SNIPPETS)
-        elif r < 0.80:
-            payload = random.choice(LORE_SNIPPETS)
-        else:
-            payload = random.choice(NOCLASS_TEXT)
-
-        create_anomaly(conn, uid, "N", payload)
+            pid = next_payload_id(conn, uid, "S")
+            if pid:
+                kind = "S"
+
+        if kind != "S":
+            if r < 0.60:
+                pid = next_payload_id(conn, uid, "FRAGMENT")
+            elif r < 0.80:
+                pid = next_payload_id(conn, uid, "LORE")
+            else:
+                pid = random_payload_id(conn, "NOCLASS")
+
+        by_shard.setdefault(shard_of(uid), []).append((uid, kind, pid))
+        notify.append((uid, "Новый пакет данных от NEZ Project доступен."))
+
+    await asyncio.gather(*(
+        asyncio.to_thread(write_wave_shard, i, items, wave, ts)
+        for i, items in by_shard.items()
+    ))
+
+    await send_bulk(bulk_bot(context.application), notify)
+
+# ================== EXPORT ==================
+# Файлы пишутся построчно во временный файл в отдельном потоке:
+# строки идут из генераторов поверх курсора, весь результат в памяти не собирается.
+def iter_queue_export(conn):
+    # очки — из кэша пользователей: users может лежать в другом файле (шарде)
+    cur = conn.execute("SELECT rank, user_id, username, pri FROM queue_rank ORDER BY rank")
+    for rank, uid, username, pri in cur:
+        user = _user_rows.get(uid)
+        points = int(user[2]) if user else 0
+        yield rank, uid, username, points, pri, access_level(points)
+
+def iter_history_export(conn):
+    # ключ строки — (shard, id): каждый шард выдаёт id anomalies сам
+    cur = scatter(conn, """
+        SELECT {shard}, a.id, a.user_id, u.username, a.kind, a.status, a.created_at, a.fixed_at, a.wave
+        FROM {anomalies} a
+        LEFT JOIN {users} u ON u.user_id = a.user_id
+        ORDER BY a.id
+    """)
+    for r in cur:
+        yield {
+            "shard": r[0],
+            "id": r[1],
+            "user_id": r[2],
+            "username": r[3],
+            "kind": r[4],
+            "status": r[5],
+            "created_at": r[6],
+            "fixed_at": r[7],
+            "wave": r[8],
+        }
+
+def _write_temp(suffix: str, fill, **kw) -> str:
+    # delete=False: файл отправляет export_to_admin и удаляет сам; при ошибке записи — удаляем тут
+    import tempfile
 
+    conn = db()
+    f = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False, encoding="utf-8", **kw)
+    try:
+        with f:
+            fill(conn, f)
+    except:
+        os.unlink(f.name)
+        raise
+    finally:
+        conn.close()
+    return f.name
+
+def write_queue_csv() -> str:
+    import csv
+
+    def fill(conn, f):
+        w = csv.writer(f)
+        w.writerow(["rank", "user_id", "username", "points", "priority", "access_level"])
+        for row in iter_queue_export(conn):
+            w.writerow(row)
+
+    return _write_temp(".csv", fill, newline="")
+
+def write_history_jsonl() -> str:
+    def fill(conn, f):
+        for row in iter_history_export(conn):
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    return _write_temp(".jsonl", fill)
+
+async def export_to_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    # очередь — из снимка queue_rank, который обновляет rank_refresh_job;
+    # полный пересчёт на event loop здесь не делаем
+    warm_user_cache(db())
+    stamp = datetime.now(TZ).strftime("%Y%m%d_%H%M")
+    for writer, filename in (
+        (write_queue_csv, f"queue_{stamp}.csv"),
+        (write_history_jsonl, f"history_{stamp}.jsonl"),
+    ):
+        path = await asyncio.to_thread(writer)
         try:
-            await context.bot.send_message(uid, "Новый пакет данных от NEZ Project доступен.")
-        except:
-            pass
+            with open(path, "rb") as f:
+                await context.bot.send_document(chat_id, document=f, filename=filename)
+        finally:
+            os.unlink(path)
 
 # ================== AUTO SCHEDULING (3 random times/day) ==================
 def _today_key(dt: datetime) -> str:
@@ -982,32 +2280,185 @@ async def daily_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
     delay = seconds_until_next_anchor(now_local)
     app.job_queue.run_once(daily_scheduler_job, when=delay, name="daily_scheduler")
 
-# ================== APP ==================
-def build_app():
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_click))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
-    app.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, on_audio))
-    return app
+# ================== STARTUP ==================
+WEBHOOK_META_KEY = "webhook_url"
 
-if __name__ == "__main__":
-    application = build_app()
+_startup_done = False
+
+def webhook_url() -> str:
+    return f"{BASE_URL.rstrip('/')}/{WEBHOOK_PATH}"
+
+async def sync_webhook(app: Application, verify: bool = False):
+    url = webhook_url()
+    conn = db()
+    if not verify and get_meta(conn, WEBHOOK_META_KEY) == url:
+        return  # вебхук уже зарегистрирован — не тратим setWebhook на пробуждение
+
+    if verify:
+        info = await app.bot.get_webhook_info()
+        if info.url == url:
+            set_meta(conn, WEBHOOK_META_KEY, url)
+            return
+
+    await app.bot.set_webhook(url=url)
+    set_meta(conn, WEBHOOK_META_KEY, url)
+
+async def run_startup_tasks(app: Application):
+    # всё, без чего можно ответить на первый апдейт: DDL, планирование, проверка вебхука
+    global _startup_done
+    if _startup_done:
+        return
+    _startup_done = True
+
+    conn = db()
+    ensure_schema(conn)
+    warm_user_cache(conn)
+    warm_payload_cache(conn)
+    warm_progress_cache(conn)
 
     # schedule packets for today on boot (if not already)
-    schedule_packets_for_today(application)
+    schedule_packets_for_today(app)
 
     # schedule daily scheduler (~00:05 Amsterdam)
     now_local = datetime.now(TZ)
     first_delay = seconds_until_next_anchor(now_local)
-    application.job_queue.run_once(daily_scheduler_job, when=first_delay, name="daily_scheduler")
+    app.job_queue.run_once(daily_scheduler_job, when=first_delay, name="daily_scheduler")
+    app.job_queue.run_repeating(rank_refresh_job, interval=RANK_REFRESH_SEC, first=RANK_REFRESH_SEC, name="rank_refresh")
 
     if BASE_URL:
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path="telegram",
-            webhook_url=f"{BASE_URL.rstrip('/')}/telegram"
-        )
+        await verify_webhook(app)
+
+WEBHOOK_RETRY_SEC = 60
+
+async def verify_webhook(app: Application):
+    # при сбое getWebhookInfo/setWebhook проверка повторяется, пока не пройдёт
+    try:
+        await sync_webhook(app, verify=True)
+    except Exception:
+        log.exception("webhook verify failed, retry in %ss", WEBHOOK_RETRY_SEC)
+        app.job_queue.run_once(verify_webhook_job, when=WEBHOOK_RETRY_SEC, name="webhook_verify")
+
+async def verify_webhook_job(context: ContextTypes.DEFAULT_TYPE):
+    await verify_webhook(context.application)
+
+async def after_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # группа 1: выполняется после того, как основной обработчик уже ответил
+    if not _startup_done:
+        context.application.create_task(run_startup_tasks(context.application))
+
+async def cold_start_fallback_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_startup_tasks(context.application)
+
+async def post_init(app: Application):
+    if COLD_START:
+        # если апдейтов нет — всё равно доделываем старт через COLD_START_MAX_DEFER_SEC
+        app.job_queue.run_once(cold_start_fallback_job, when=COLD_START_MAX_DEFER_SEC, name="cold_start_fallback")
+    else:
+        await run_startup_tasks(app)
+
+async def serve_webhook(apps):
+    # свой tornado-сервер вместо run_webhook: run_webhook вызывает setWebhook на каждом старте.
+    # apps: [(модуль кампании, Application)] — один сервер и PORT, у каждой кампании свой путь
+    from tornado.httpserver import HTTPServer
+    from tornado.web import Application as WebApp, RequestHandler
+
+    class WebhookHandler(RequestHandler):
+        def initialize(self, app: Application):
+            self.app = app
+
+        async def post(self):
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            upd = Update.de_json(data, self.app.bot)
+            if upd:
+                await self.app.update_queue.put(upd)
+            self.set_status(200)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    for _, app in apps:
+        await app.initialize()
+        await app.start()
+    server = HTTPServer(WebApp([
+        (f"/{mod.WEBHOOK_PATH}", WebhookHandler, {"app": app}) for mod, app in apps
+    ]))
+    server.listen(PORT, address="0.0.0.0")
+    for mod, app in apps:
+        await mod.sync_webhook(app)
+        await mod.post_init(app)
+
+    await stop.wait()
+
+    server.stop()
+    for _, app in apps:
+        await app.stop()
+    # общий пул закрывается только после остановки всех кампаний
+    for mod, app in apps:
+        await mod.post_shutdown(app)
+        await app.shutdown()
+
+# ================== TENANTS ==================
+def load_tenants(path: str):
+    with open(path, encoding="utf-8") as f:
+        configs = json.load(f)
+
+    seen: dict[str, set] = {"name": set(), "BOT_TOKEN": set(), "DB_PATH": set(), "WEBHOOK_PATH": set()}
+    for cfg in configs:
+        for key, values in seen.items():
+            if not cfg.get(key):
+                raise RuntimeError(f"tenant {cfg.get('name')!r}: {key} not set")
+            if cfg[key] in values:
+                raise RuntimeError(f"tenant {cfg['name']!r}: duplicate {key}")
+            values.add(cfg[key])
+
+    # один пул соединений к Bot API на все кампании, отдельный — на рассылки
+    request = make_request(HTTP_POOL_SIZE)
+    bulk_request = make_request(HTTP_BULK_POOL_SIZE)
+    apps = []
+    for cfg in configs:
+        spec = importlib.util.spec_from_file_location(f"nez_{cfg['name']}", os.path.abspath(__file__))
+        mod = importlib.util.module_from_spec(spec)
+        mod.TENANT = cfg
+        spec.loader.exec_module(mod)
+        if not mod.BASE_URL:
+            # из tenants.json или общего окружения; без него вебхук кампании не зарегистрировать
+            raise RuntimeError(f"tenant {cfg['name']!r}: BASE_URL not set")
+        mod._bulk_request = bulk_request
+        apps.append((mod, mod.build_app(request=request)))
+    return apps
+
+# ================== APP ==================
+def build_app(request: Optional[BaseRequest] = None):
+    if not TOKEN:
+        raise RuntimeError("BOT_TOKEN not set")
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request or make_request(HTTP_POOL_SIZE))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CallbackQueryHandler(on_click))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, on_audio))
+    app.add_handler(TypeHandler(Update, after_first_update), group=1)
+    app.add_handler(TypeHandler(Update, profiler_after_update), group=2)
+    return app
+
+if __name__ == "__main__":
+    if TENANTS_FILE:
+        asyncio.run(serve_webhook(load_tenants(TENANTS_FILE)))
+    elif BASE_URL:
+        asyncio.run(serve_webhook([(sys.modules[__name__], build_app())]))
     else:
-        application.run_polling()
+        build_app().run_polling()
@@ -0,0 +1,121 @@
+"""Reshard: перенос базы в другое число шардов (DB_SHARDS).
+
+Глобальные таблицы копируются в новый DB_PATH как есть, пользовательские
+раскладываются по файлам шардов тем же хэшем user_id, что и в боте.
+id в anomalies у каждого шарда свои (AUTOINCREMENT), поэтому не копируются:
+новые выдаёт получатель, порядок строк пользователя сохраняется.
+Новая база собирается во временном каталоге рядом с --dst и переносится
+на место только целиком; при ошибке каталог удаляется.
+Бот на время переноса должен быть остановлен.
+
+    python reshard.py --src /var/data/nez.db --dst /var/data/new/nez.db --shards 4
+    python reshard.py --src /var/data/nez.db --src-shards 4 --dst /var/data/one/nez.db --shards 1
+"""
+import os
+import sys
+import shutil
+import argparse
+
+GLOBAL_TABLES = (
+    "s_audio", "scheduler_meta", "username_changes", "payloads", "queue_rank",
+)
+# суррогатные ключи, которые шарды выдают независимо: при слиянии пересекаются
+RENUMBERED = {"anomalies": "id"}
+
+def columns(conn, schema: str, table: str) -> list[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--src", required=True, help="DB_PATH исходной базы")
+    ap.add_argument("--src-shards", type=int, default=1, help="DB_SHARDS исходной базы")
+    ap.add_argument("--dst", required=True, help="DB_PATH новой базы")
+    ap.add_argument("--shards", type=int, required=True, help="DB_SHARDS новой базы")
+    args = ap.parse_args()
+
+    dst_dir = os.path.dirname(os.path.abspath(args.dst))
+    tmp_dir = os.path.join(dst_dir, f".reshard-{os.getpid()}")
+    os.environ["DB_PATH"] = os.path.join(tmp_dir, os.path.basename(args.dst))
+    os.environ["DB_SHARDS"] = str(args.shards)
+    try:
+        import main as bot  # проверяет DB_SHARDS против лимита ATTACH до создания файлов
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+    os.makedirs(tmp_dir)
+    try:
+        moves = build(bot, args)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    for tmp, final in moves:
+        os.replace(tmp, final)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def build(bot, args) -> list:
+    # собирает базу в bot.DB_PATH (временный каталог); возвращает пары (временный файл, место)
+    tmp_files = [bot.DB_PATH] + ([bot.shard_path(i) for i in range(bot.shard_count())] if bot.DB_SHARDS > 1 else [])
+    dst_files = [args.dst] + ([bot.shard_path(i, args.dst) for i in range(bot.shard_count())] if bot.DB_SHARDS > 1 else [])
+    if any(os.path.exists(p) for p in dst_files):
+        sys.exit("dst уже существует")
+    src_files = [bot.shard_path(i, args.src, args.src_shards) for i in range(max(1, args.src_shards))]
+    missing = [p for p in [args.src] + src_files if not os.path.exists(p)]
+    if missing:
+        sys.exit("нет файлов: " + ", ".join(missing))
+
+    conn = bot.db()  # пустая схема нужной версии во всех файлах
+    conn.create_function("nez_shard", 1, bot.shard_of, deterministic=True)
+
+    conn.execute("ATTACH DATABASE ? AS src", (args.src,))
+    version = conn.execute("PRAGMA src.user_version").fetchone()[0]
+    if version != bot.SCHEMA_VERSION:
+        sys.exit(f"версия схемы src {version}, нужна {bot.SCHEMA_VERSION}: сначала запустите бота на старой базе")
+    row = conn.execute("SELECT v FROM src.scheduler_meta WHERE k=?", (bot.SHARDS_META_KEY,)).fetchone()
+    if row and int(row[0]) != max(1, args.src_shards):
+        sys.exit(f"src записана с DB_SHARDS={row[0]}, указано --src-shards {args.src_shards}")
+
+    for table in GLOBAL_TABLES:
+        cols = ", ".join(columns(conn, "main", table))
+        conn.execute(f"DELETE FROM main.{table}")  # db() мог засеять каталог
+        conn.execute(f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM src.{table}")
+    bot.set_meta(conn, bot.SHARDS_META_KEY, str(bot.shard_count()))  # вместо скопированного из src
+    conn.commit()
+    conn.execute("DETACH DATABASE src")
+
+    for n, path in enumerate(src_files):
+        conn.execute("ATTACH DATABASE ? AS src", (path,))
+        for table in bot.USER_TABLES:
+            skip = RENUMBERED.get(table)
+            cols = ", ".join(c for c in columns(conn, "src", table) if c != skip)
+            order = f" ORDER BY {skip}" if skip else ""
+            for i in range(bot.shard_count()):
+                dst = bot.shard_tables(i)[table]
+                conn.execute(
+                    f"INSERT INTO {dst} ({cols}) SELECT {cols} FROM src.{table} WHERE nez_shard(user_id) = ?{order}",
+                    (i,)
+                )
+        # счётчики статистики: итоги складываются в первый шард, активные за день — по user_id
+        conn.executemany(
+            bot.STAT_UPSERT.format_map(bot.shard_tables(0)),
+            conn.execute("SELECT bucket, name, v FROM src.stat_counters").fetchall()
+        )
+        for i in range(bot.shard_count()):
+            conn.execute(
+                f"INSERT OR IGNORE INTO {bot.shard_tables(i)['stat_day_users']} (day, user_id) "
+                f"SELECT day, user_id FROM src.stat_day_users WHERE nez_shard(user_id) = ?",
+                (i,)
+            )
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
+        print(f"{path}: перенесён")
+
+    for i, path in enumerate(dst_files[1:] or dst_files):
+        t = bot.shard_tables(i)
+        users = conn.execute(f"SELECT COUNT(*) FROM {t['users']}").fetchone()[0]
+        anomalies = conn.execute(f"SELECT COUNT(*) FROM {t['anomalies']}").fetchone()[0]
+        print(f"{path}: users {users}, anomalies {anomalies}")
+    conn.close()
+    return list(zip(tmp_files, dst_files))
+
+if __name__ == "__main__":
+    main()
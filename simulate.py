@@ -0,0 +1,283 @@
+"""Offline ranking simulator: replay scoring history under alternative parameters.
+
+Читает копию базы (users, anomalies.created_at/fixed_at), строит события
+начисления очков и проигрывает их по времени дважды: с текущими параметрами
+бота и с альтернативными. Печатает изменения позиций на конец истории,
+по --series пишет CSV с top-N на каждом шаге.
+
+    python simulate.py --db /tmp/nez-copy.db --half-life 1.5 --points-weight 0.7
+    python simulate.py --db /tmp/nez-copy.db --curve "10:8,30:5,120:2,inf:1" --series top.csv
+
+Время DONE в базе не хранится: расшифровка считается выполненной через
+--done-delay секунд после FIXED. Периоды заморозки не воспроизводятся.
+"""
+import os
+import sys
+import csv
+import math
+import heapq
+import time
+import sqlite3
+import argparse
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+bot = None  # main.py; импортируется в main() после DB_SHARDS из аргументов
+
+DONE_POINTS = {"S": 4}   # остальные виды — 2, как в on_click
+DONE_POINTS_OTHER = 2
+
+class Params(NamedTuple):
+    half_life_days: float
+    points_weight: float
+    curve: tuple          # ((порог_сек | None, очки), ...), None — «иначе»
+    done_delay: int
+
+def parse_curve(text: str) -> tuple:
+    curve = []
+    for part in text.split(","):
+        limit, pts = part.split(":")
+        curve.append((None if limit.strip() == "inf" else int(limit), int(pts)))
+    return tuple(curve)
+
+def format_curve(curve) -> str:
+    return ",".join(f"{'inf' if limit is None else limit}:{pts}" for limit, pts in curve)
+
+def confirm(curve, elapsed: int) -> int:
+    for limit, pts in curve:
+        if limit is None or elapsed <= limit:
+            return pts
+    return 0
+
+# ================== HISTORY ==================
+def open_copy(path: str, shards: int):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    if shards > 1:
+        for i in range(shards):
+            conn.execute("ATTACH DATABASE ? AS ?", (f"file:{bot.shard_path(i, path, shards)}?mode=ro", f"s{i}"))
+    return conn
+
+def load_history(conn):
+    users = sorted(
+        (int(uid), name, int(created_at or 0))
+        for uid, name, created_at in bot.scatter(conn, "SELECT user_id, username, created_at FROM {users}")
+    )
+    anomalies = list(bot.scatter(conn, """
+        SELECT user_id, kind, status, created_at, fixed_at
+        FROM {anomalies}
+        WHERE fixed_at IS NOT NULL
+    """))
+    return users, anomalies
+
+def build_events(anomalies, index: dict, p: Params):
+    # (ts, индекс пользователя, очки), по времени
+    events = []
+    for uid, kind, status, created_at, fixed_at in anomalies:
+        i = index.get(int(uid))
+        if i is None:
+            continue
+        fixed_at = int(fixed_at)
+        events.append((fixed_at, i, confirm(p.curve, max(0, fixed_at - int(created_at or fixed_at)))))
+        if status == "DONE":
+            events.append((fixed_at + p.done_delay, i, DONE_POINTS.get(kind, DONE_POINTS_OTHER)))
+    events.sort()
+    return events
+
+# ================== ENGINE ==================
+# Состояние — плоские списки по индексу пользователя. Активность хранится как в боте:
+# key = log2(score) + ts / half_life, поэтому событие — O(1) без пересчёта остальных,
+# а порядок по key от времени не зависит. Для снимка top-N два порядка (по очкам и
+# по key) досортировываются (почти отсортированные — Timsort за ~O(n)) и обходятся
+# параллельно до порога (threshold algorithm): считается только голова рейтинга.
+def replay(users, events, p: Params, snapshots, top: int):
+    n = len(users)
+    created = [u[2] for u in users]
+    points = [0] * n
+    keys = [-math.inf] * n
+    half_life = p.half_life_days * 24 * 3600
+    pw = p.points_weight
+    log1p = math.log1p
+
+    by_points = list(range(n))
+    by_key = list(range(n))
+
+    def norms(t: int):
+        shift = t / half_life if half_life > 0 else 0.0
+        max_p = log1p(points[by_points[0]]) or 1.0
+        max_a = log1p(2.0 ** (keys[by_key[0]] - shift)) or 1.0
+        return shift, max_p, max_a
+
+    def entry(i: int, shift: float, max_p: float, max_a: float):
+        # та же формула, что _blend в боте; порядок — как в ordered_users
+        b = pw * (log1p(points[i]) / max_p) + (1.0 - pw) * (log1p(2.0 ** (keys[i] - shift)) / max_a)
+        return (-b, -points[i], created[i], i)
+
+    def head(t: int, limit: int):
+        by_points.sort(key=points.__getitem__, reverse=True)
+        by_key.sort(key=keys.__getitem__, reverse=True)
+        shift, max_p, max_a = norms(t)
+        seen = set()
+        best = []   # max-heap по худшему из лучших: (-entry[0], entry)
+        for d in range(n):
+            for i in (by_points[d], by_key[d]):
+                if i in seen or created[i] > t:
+                    continue
+                seen.add(i)
+                e = entry(i, shift, max_p, max_a)
+                if len(best) < limit:
+                    heapq.heappush(best, _Worst(e))
+                elif e < best[0].e:
+                    heapq.heapreplace(best, _Worst(e))
+            if len(best) == limit:
+                bound = pw * (log1p(points[by_points[d]]) / max_p) + \
+                    (1.0 - pw) * (log1p(2.0 ** (keys[by_key[d]] - shift)) / max_a)
+                if -best[0].e[0] > bound:
+                    break   # ни один непросмотренный не обгонит последнего в голове
+        return [(e[3], int(round(-e[0] * 1000))) for e in sorted(w.e for w in best)]
+
+    def full(t: int):
+        by_points.sort(key=points.__getitem__, reverse=True)
+        by_key.sort(key=keys.__getitem__, reverse=True)
+        shift, max_p, max_a = norms(t)
+        rows = sorted(entry(i, shift, max_p, max_a) for i in range(n) if created[i] <= t)
+        return [(e[3], int(round(-e[0] * 1000))) for e in rows]
+
+    series = []
+    snaps = iter(snapshots)
+    next_snap = next(snaps, None)
+    for ts, i, pts in events:
+        while next_snap is not None and next_snap < ts:
+            series.append((next_snap, head(next_snap, top)))
+            next_snap = next(snaps, None)
+        points[i] += pts
+        if half_life > 0:
+            score = 2.0 ** (keys[i] - ts / half_life) + pts
+            keys[i] = math.log2(score) + ts / half_life if score > 0 else -math.inf
+    while next_snap is not None:
+        series.append((next_snap, head(next_snap, top)))
+        next_snap = next(snaps, None)
+
+    final = full(snapshots[-1]) if snapshots else []
+    return final, series
+
+class _Worst:
+    # элемент max-heap: наверху худший из текущей головы рейтинга
+    __slots__ = ("e",)
+
+    def __init__(self, e):
+        self.e = e
+
+    def __lt__(self, other):
+        return self.e > other.e
+
+# ================== REPORT ==================
+def report(users, base_final, alt_final, top: int, movers: int):
+    base_rank = {i: r for r, (i, _) in enumerate(base_final, 1)}
+    alt_rank = {i: r for r, (i, _) in enumerate(alt_final, 1)}
+    deltas = [(base_rank[i] - alt_rank[i], i) for i in alt_rank if i in base_rank]
+    moved = [d for d in deltas if d[0]]
+
+    base_top = {i for i, _ in base_final[:top]}
+    alt_top = {i for i, _ in alt_final[:top]}
+    print(f"Пользователей в рейтинге: {len(alt_final)}, сменили позицию: {len(moved)}")
+    if deltas:
+        print(f"Среднее |Δ позиции|: {sum(abs(d) for d, _ in deltas) / len(deltas):.2f}, "
+              f"максимум: {max(abs(d) for d, _ in deltas)}")
+    print(f"Top-{top}: совпадает {len(base_top & alt_top)}/{min(top, len(alt_final))}")
+
+    def line(d, i):
+        uid, name, _ = users[i]
+        return f"  {name} ({uid}): {base_rank[i]} → {alt_rank[i]} ({'+' if d > 0 else ''}{d})"
+
+    moved.sort()
+    if moved:
+        print("\nПоднялись:")
+        for d, i in reversed(moved[-movers:]):
+            if d > 0:
+                print(line(d, i))
+        print("\nОпустились:")
+        for d, i in moved[:movers]:
+            if d < 0:
+                print(line(d, i))
+
+    print(f"\nTop-{top} (текущие → альтернативные параметры):")
+    for r in range(min(top, len(alt_final))):
+        b = users[base_final[r][0]][1] if r < len(base_final) else "-"
+        a = users[alt_final[r][0]][1]
+        print(f"  {r + 1:>3}. {b:<24} {a}")
+
+def write_series(path: str, users, runs):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["scenario", "ts", "time", "rank", "user_id", "username", "pri"])
+        for scenario, series in runs:
+            for ts, rows in series:
+                stamp = datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M")
+                for r, (i, pri) in enumerate(rows, 1):
+                    w.writerow([scenario, ts, stamp, r, users[i][0], users[i][1], pri])
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", required=True, help="копия базы (DB_PATH)")
+    ap.add_argument("--shards", type=int, default=1, help="DB_SHARDS копии")
+    ap.add_argument("--half-life", type=float, help="ACTIVITY_HALF_LIFE_DAYS, дни")
+    ap.add_argument("--points-weight", type=float, help="вес очков в приоритете, 0..1")
+    ap.add_argument("--curve", help='кривая confirm_points: "5:8,10:7,...,inf:1"')
+    ap.add_argument("--done-delay", type=int, default=60, help="сек от FIXED до DONE")
+    ap.add_argument("--step-hours", type=float, default=6.0, help="шаг снимков top-N")
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument("--movers", type=int, default=10)
+    ap.add_argument("--series", help="CSV с top-N по времени для обоих сценариев")
+    args = ap.parse_args()
+
+    global bot
+    os.environ["DB_SHARDS"] = str(args.shards)
+    import main as bot
+
+    base = Params(
+        half_life_days=float(bot.ACTIVITY_HALF_LIFE_DAYS),
+        points_weight=bot.RANK_POINTS_WEIGHT,
+        curve=tuple((b, bot.confirm_points(b)) for b in bot.LATENCY_BINS) + ((None, bot.confirm_points(10 ** 9)),),
+        done_delay=args.done_delay,
+    )
+    alt = base._replace(
+        half_life_days=base.half_life_days if args.half_life is None else args.half_life,
+        points_weight=base.points_weight if args.points_weight is None else args.points_weight,
+        curve=base.curve if args.curve is None else parse_curve(args.curve),
+    )
+
+    t0 = time.perf_counter()
+    conn = open_copy(args.db, args.shards)
+    users, anomalies = load_history(conn)
+    conn.close()
+    if not users:
+        sys.exit("в базе нет пользователей")
+    index = {u[0]: i for i, u in enumerate(users)}
+
+    runs = []
+    finals = []
+    n_events = 0
+    for scenario, p in (("base", base), ("alt", alt)):
+        events = build_events(anomalies, index, p)
+        n_events = len(events)
+        start = min([u[2] for u in users] + [e[0] for e in events[:1]])
+        end = max([u[2] for u in users] + [e[0] for e in events[-1:]])
+        step = max(1, int(args.step_hours * 3600))
+        snapshots = list(range(start + step, end, step)) + [end]
+        final, series = replay(users, events, p, snapshots, args.top)
+        runs.append((scenario, series))
+        finals.append(final)
+
+    print(f"История: {len(users)} пользователей, {n_events} начислений, "
+          f"проигрывание {time.perf_counter() - t0:.2f} с")
+    print(f"Период полураспада: {base.half_life_days:g} → {alt.half_life_days:g} дн.")
+    print(f"Вес очков: {base.points_weight:g} → {alt.points_weight:g}")
+    print(f"Кривая: {format_curve(base.curve)} → {format_curve(alt.curve)}\n")
+    report(users, finals[0], finals[1], args.top, args.movers)
+
+    if args.series:
+        write_series(args.series, users, runs)
+        print(f"\nРяды top-{args.top}: {args.series}")
+
+if __name__ == "__main__":
+    main()